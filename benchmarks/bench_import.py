@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Import time benchmark. Imports the integration in fresh interpreters (so nothing is already cached in sys.modules),
+# reports the median wall time, and lists which heavy modules the import pulled in. Heavy modules should only be
+# imported when a query is run or a result displayed, not when the integration is loaded.
+#
+# python benchmarks/bench_import.py --module hive_core --runs 20 --importtime
+# The template itself can be benchmarked with --name hive, which fills in the integration name placeholder
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+heavy_modules = ['pandas', 'numpy', 'pyarrow', 'pyhive', 'thrift', 'requests', 'ipywidgets', 'beakerx']
+
+child_code = """
+import sys, time, json, builtins
+%s
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps({'seconds': t, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+# integration_base uses name_str = integration until a real integration fills it in
+def nameCode(name):
+    if name is None:
+        return "pass"
+    return "builtins.integration = %r" % name
+
+
+def timeImport(module, python, name=None):
+    out = subprocess.check_output([python, "-c", child_code % (nameCode(name), module, heavy_modules)], env=childEnv())
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+# Top entries of python -X importtime (cumulative microseconds), to see what an import is spending its time on
+def importTimes(module, python, top, name=None):
+    code = "import builtins; %s; import %s" % (nameCode(name), module)
+    p = subprocess.run([python, "-X", "importtime", "-c", code], env=childEnv(),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in p.stderr.decode("utf-8").splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append((int(parts[1]), parts[2].rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def childEnv():
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time importing an integration in fresh interpreters")
+    parser.add_argument("--module", default="integration_core", help="Module to import (the generated integration, e.g. hive_core)")
+    parser.add_argument("--name", default=None, help="Integration name to fill in when benchmarking the template itself (e.g. hive)")
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh interpreter runs")
+    parser.add_argument("--python", default=sys.executable, help="Python interpreter to run the imports with")
+    parser.add_argument("--importtime", action="store_true", help="Also show the slowest imports from python -X importtime")
+    parser.add_argument("--top", type=int, default=15, help="Number of -X importtime entries to show")
+    args = parser.parse_args()
+
+    times = []
+    loaded = []
+    for i in range(max(args.runs, 1)):
+        try:
+            res = timeImport(args.module, args.python, args.name)
+        except subprocess.CalledProcessError:
+            print("Error: import %s failed (use --name when benchmarking the template itself)" % args.module)
+            sys.exit(1)
+        times.append(res['seconds'])
+        loaded = res['loaded']
+
+    print("{: <30} {: <80}".format(*["Module", args.module]))
+    print("{: <30} {: <80}".format(*["Runs", str(len(times))]))
+    print("{: <30} {: <80}".format(*["Median import (ms)", "%.1f" % (statistics.median(times) * 1000)]))
+    print("{: <30} {: <80}".format(*["Min / Max import (ms)", "%.1f / %.1f" % (min(times) * 1000, max(times) * 1000)]))
+    print("{: <30} {: <80}".format(*["Heavy modules loaded", ", ".join(loaded) if len(loaded) > 0 else "None"]))
+
+    if args.importtime:
+        print("")
+        print("{: <15} {: <80}".format(*["Cumulative ms", "Import"]))
+        for us, name in importTimes(args.module, args.python, args.top, args.name):
+            print("{: <15} {: <80}".format(*["%.1f" % (us / 1000.0), name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+# Query path benchmark. Runs queries through an Integration whose newConnection is replaced by an in process
+# backend (see fake_dbapi.py). It measures time, throughput and peak memory for every stage, across result sizes:
+#
+#   cell      %%hive end to end, broken into the query history phases (execute, first_row, fetch, frame, ...)
+#   stream    %%hive --stream end to end (fetchmany batches, keeping every row)
+#   postfetch postFetch with pd_shrink_dtypes on (downcasting and categories)
+#   html      the HTML table for the rows that are displayed (pd_display.max_rows)
+#   paged     building the paged widget (first page only), if ipywidgets is installed
+#   beaker    building the BeakerX TableDisplay for the displayed rows, if beakerx is installed
+#   load      --load N queries through runBatch on --concurrency pooled connections, reported as queries/sec
+#
+# Times are the median of --repeat runs. Memory is the tracemalloc peak of one more run, done separately so
+# tracing doesn't slow down the timed runs. Results can be saved as a baseline and later runs compared to it:
+#
+#   python benchmarks/bench_query.py --module hive_core --class Hive --save baseline.json
+#   python benchmarks/bench_query.py --module hive_core --class Hive --compare baseline.json
+#
+# With --compare the exit code is 1 if any stage got slower or bigger than --threshold (a fraction) allows.
+# The template itself can be benchmarked with --name hive, which fills in the integration name placeholder
+import os
+import sys
+import json
+import time
+import argparse
+import builtins
+import platform
+import importlib
+import statistics
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_dbapi import FakeConnection, SharedConnection, sqliteConnection
+
+query_phases = ['validate', 'acquire', 'execute', 'first_row', 'fetch', 'frame', 'render']
+
+
+def loadIntegration(module, cls, name=None):
+    if name is not None:
+        # integration_base uses name_str = integration until a real integration fills it in
+        builtins.integration = name
+    return getattr(importlib.import_module(module), cls)
+
+
+# Make an Integration connected to backend (a function returning a new connection)
+def makeIntegration(klass, backend, rows):
+    from IPython.testing.globalipapp import get_ipython
+
+    class BenchIntegration(klass):
+        def newConnection(self):
+            return backend()
+
+    shell = get_ipython()
+    integration = BenchIntegration(shell)
+    name = integration.name_str
+    integration.opts[name + '_pool_ping_interval'][0] = 0
+    integration.opts[name + '_cache'][0] = False
+    integration.opts[name + '_meta_preload'][0] = ""
+    integration.opts[name + '_max_rows'][0] = rows
+    integration.opts[name + '_history_size'][0] = 1000
+    if integration.auth() != 0:
+        raise Exception("Could not connect to the benchmark backend")
+    integration.connected = True
+    return integration
+
+
+def benchQuery(integration, rows):
+    return "SELECT * FROM bench WHERE %s = '2020-01-01' LIMIT %s" % (integration.opts[integration.name_str + '_partition_col'][0], rows)
+
+
+# %%hive (and --stream) print and display, which we don't want in the benchmark output
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+# Each case returns (seconds, phases) where phases is a dict of phase -> seconds (empty if it has no phases)
+def runCell(integration, query, args=""):
+    magic = getattr(integration, integration.name_str)
+    with quiet():
+        magic(args, query)
+    rec = integration.history.records[-1]
+    if rec['status'].find("Success") != 0:
+        raise Exception("Query failed: %s" % rec['status'])
+    phases = OrderedDict((p, rec[p]) for p in query_phases if rec.get(p, None) is not None)
+    return rec['total'], phases
+
+
+def timed(func, *args):
+    t = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t, OrderedDict()
+
+
+def displayRows(integration, df):
+    return integration.prepareDisplay(df.head(int(integration.opts['pd_display.max_rows'][0])))
+
+
+def makeCases(integration, query, df):
+    cases = OrderedDict()
+    cases['cell'] = lambda: runCell(integration, query)
+    cases['stream'] = lambda: runCell(integration, query, "--stream")
+
+    def postfetch():
+        integration.opts['pd_shrink_dtypes'][0] = True
+        try:
+            frame = df.copy()
+            return timed(integration.postFetch, frame)
+        finally:
+            integration.opts['pd_shrink_dtypes'][0] = False
+    cases['postfetch'] = postfetch
+    cases['html'] = lambda: timed(lambda: displayRows(integration, df).to_html(index=integration.opts['pd_display_idx'][0]))
+
+    try:
+        importlib.import_module('ipywidgets')
+        from integration_core.paged_display import PagedTable
+        cases['paged'] = lambda: timed(PagedTable, df, integration.opts['pd_page_size'][0], integration.opts['pd_display_idx'][0], integration.prepareDisplay)
+    except ImportError:
+        pass
+    try:
+        from beakerx import TableDisplay
+
+        def beaker():
+            integration.opts['pd_use_beaker'][0] = True
+            try:
+                return timed(lambda: TableDisplay(displayRows(integration, df)))
+            finally:
+                integration.opts['pd_use_beaker'][0] = False
+        cases['beaker'] = beaker
+    except ImportError:
+        pass
+    return cases
+
+
+def measure(case, repeat):
+    times = []
+    phase_times = OrderedDict()
+    for i in range(repeat):
+        seconds, phases = case()
+        times.append(seconds)
+        for p, v in phases.items():
+            phase_times.setdefault(p, []).append(v)
+    tracemalloc.start()
+    try:
+        case()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), OrderedDict((p, statistics.median(v)) for p, v in phase_times.items()), peak / 1048576.0
+
+
+def runLoad(integration, query, count, concurrency):
+    keys = list(range(1, count + 1))
+    t = time.perf_counter()
+    with quiet():
+        result, statuses = integration.runBatch(keys, [query] * count, workers=concurrency, combine="dict")
+    seconds = time.perf_counter() - t
+    failed = len([s for k, s in statuses if s.find("Success") != 0])
+    if failed > 0:
+        raise Exception("%s of %s load queries failed" % (failed, count))
+    return seconds
+
+
+def runBenchmarks(args):
+    import pandas as pd
+    klass = loadIntegration(args.module, args.cls, args.name)
+    results = OrderedDict()
+    for rows in [int(x) for x in args.rows.split(",")]:
+        if args.backend == "sqlite":
+            shared = sqliteConnection(rows, args.cols)
+            backend = lambda shared=shared: SharedConnection(shared)
+        else:
+            backend = lambda rows=rows: FakeConnection(rows, args.cols, args.latency, args.fetch_latency)
+        integration = makeIntegration(klass, backend, rows)
+        query = benchQuery(integration, rows)
+        runCell(integration, query) # warm up, and the frame the display cases use
+        df = integration.ipy.user_ns['prev_' + integration.name_str]
+        for name, case in makeCases(integration, query, df).items():
+            if args.cases != "" and name not in args.cases.split(","):
+                continue
+            seconds, phases, peak_mb = measure(case, args.repeat)
+            res = OrderedDict([('case', name), ('rows', rows), ('seconds', seconds), ('rows_per_sec', rows / seconds if seconds > 0 else None), ('peak_mb', peak_mb)])
+            res['phases'] = phases
+            results["%s/%s" % (name, rows)] = res
+            printResult(res)
+        if args.load > 0 and (args.cases == "" or "load" in args.cases.split(",")):
+            integration.opts[integration.name_str + '_pool_max_size'][0] = args.concurrency
+            integration.pool.close()
+            integration.auth()
+            seconds = statistics.median([runLoad(integration, query, args.load, args.concurrency) for i in range(args.repeat)])
+            res = OrderedDict([('case', 'load'), ('rows', rows), ('seconds', seconds), ('rows_per_sec', rows * args.load / seconds),
+                               ('queries_per_sec', args.load / seconds), ('peak_mb', None), ('phases', OrderedDict())])
+            results["load/%s" % rows] = res
+            printResult(res)
+        integration.pool.close()
+
+    return OrderedDict([('created', time.strftime("%Y-%m-%d %H:%M:%S")), ('python', platform.python_version()), ('pandas', pd.__version__),
+                        ('args', vars(args)), ('results', results)])
+
+
+def printHeader():
+    print("{: <10} {: <10} {: <12} {: <14} {: <10} {: <60}".format(*["Case", "Rows", "Seconds", "Rows/sec", "Peak MB", "Phases"]))
+
+
+def printResult(res):
+    phases = ", ".join(["%s %.4f" % (p, v) for p, v in res['phases'].items()])
+    if res.get('queries_per_sec', None) is not None:
+        phases = "%.1f queries/sec" % res['queries_per_sec']
+    peak = "-" if res['peak_mb'] is None else "%.1f" % res['peak_mb']
+    print("{: <10} {: <10} {: <12} {: <14} {: <10} {: <60}".format(*[res['case'], res['rows'], "%.4f" % res['seconds'], "%.0f" % (res['rows_per_sec'] or 0), peak, phases]))
+
+
+# Compare results to a saved baseline. A stage regresses if it is more than threshold (a fraction) slower or bigger,
+# and by more than min_seconds / min_mb, so tiny stages don't flag on noise. Returns the list of regressions
+def compareResults(results, baseline, threshold, min_seconds=0.01, min_mb=1.0):
+    regressions = []
+    print("")
+    print("{: <20} {: <10} {: <12} {: <12} {: <10}".format(*["Stage", "Metric", "Baseline", "Now", "Change"]))
+    for key, res in results['results'].items():
+        base = baseline['results'].get(key, None)
+        if base is None:
+            continue
+        checks = [('seconds', res['seconds'], base['seconds'], min_seconds)]
+        if res['peak_mb'] is not None and base.get('peak_mb', None) is not None:
+            checks.append(('peak_mb', res['peak_mb'], base['peak_mb'], min_mb))
+        for metric, now, was, min_delta in checks:
+            change = (now - was) / was if was > 0 else 0.0
+            flag = ""
+            if change > threshold and now - was > min_delta:
+                flag = "REGRESSION"
+                regressions.append((key, metric, was, now))
+            print("{: <20} {: <10} {: <12} {: <12} {: <10} {}".format(*[key, metric, "%.4f" % was, "%.4f" % now, "%+.1f%%" % (change * 100), flag]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the query path against an in process backend")
+    parser.add_argument("--module", default="integration_core", help="Module with the integration (e.g. hive_core)")
+    parser.add_argument("--class", dest="cls", default="Integration", help="Integration class in --module (e.g. Hive)")
+    parser.add_argument("--name", default=None, help="Integration name to fill in when benchmarking the template itself (e.g. hive)")
+    parser.add_argument("--backend", default="fake", choices=["fake", "sqlite"], help="fake generates rows in memory, sqlite runs real queries on an in memory table")
+    parser.add_argument("--rows", default="1000,10000,100000", help="Comma separated result sizes")
+    parser.add_argument("--cols", type=int, default=10, help="Number of columns")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake backend takes per execute")
+    parser.add_argument("--fetch-latency", type=float, default=0.0, help="Seconds the fake backend takes per fetch call")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage (the median is reported)")
+    parser.add_argument("--cases", default="", help="Comma separated stages to run (default all)")
+    parser.add_argument("--load", type=int, default=0, help="Also run this many queries at once through runBatch")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batch workers and pool size for --load")
+    parser.add_argument("--save", default=None, help="Save the results to this JSON file (as a baseline)")
+    parser.add_argument("--compare", default=None, help="Compare the results to this baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed fraction a stage can get slower or bigger before it is a regression")
+    args = parser.parse_args()
+    args.repeat = max(args.repeat, 1)
+
+    printHeader()
+    results = runBenchmarks(args)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print("")
+        print("Results saved to %s" % args.save)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, args.threshold)
+        print("")
+        if len(regressions) > 0:
+            print("%s regressions over %.0f%% against %s" % (len(regressions), args.threshold * 100, args.compare))
+            sys.exit(1)
+        print("No regressions over %.0f%% against %s" % (args.threshold * 100, args.compare))
+
+
+if __name__ == '__main__':
+    main()
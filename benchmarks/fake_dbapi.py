@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+# In process stand ins for a server connection, so runQuery and %%hive can be measured without a cluster.
+# FakeConnection is a DB-API connection whose cursors return rows x cols of synthetic data for any query, with
+# a controlled latency for execute and for each fetchmany call. sqliteConnection loads the same data into an
+# in memory SQLite table, for a real driver doing real work.
+#
+# Either is plugged in by overriding newConnection on the Integration (see bench_query.py)
+import time
+import sqlite3
+import threading
+
+# Column types cycle through these, so every result has a mix like a real table does
+column_types = ['int', 'float', 'category', 'string', 'bool', 'timestamp']
+
+
+def columnNames(cols):
+    return ["c%s_%s" % (i, column_types[i % len(column_types)]) for i in range(cols)]
+
+
+def makeValue(kind, row, col):
+    if kind == 'int':
+        return row * (col + 1)
+    if kind == 'float':
+        return row / (col + 1.0)
+    if kind == 'category':
+        return "group_%s" % (row % 20)
+    if kind == 'string':
+        return "value %s of column %s" % (row, col)
+    if kind == 'bool':
+        return row % 2 == 0
+    return "2020-01-%02d %02d:%02d:00" % (row % 28 + 1, row % 24, row % 60)
+
+
+def makeRows(rows, cols):
+    kinds = [column_types[i % len(column_types)] for i in range(cols)]
+    return [tuple(makeValue(kinds[c], r, c) for c in range(cols)) for r in range(rows)]
+
+
+# Generated rows are cached by shape, so building the data isn't counted as fetch time
+_rows_cache = {}
+_rows_lock = threading.Lock()
+
+
+def cachedRows(rows, cols):
+    with _rows_lock:
+        if (rows, cols) not in _rows_cache:
+            _rows_cache[(rows, cols)] = makeRows(rows, cols)
+        return _rows_cache[(rows, cols)]
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rows = []
+        self.pos = 0
+        self.cancelled = False
+        self.arraysize = 1
+
+    def execute(self, query, parameters=None):
+        self.conn.executes += 1
+        if self.conn.latency > 0:
+            time.sleep(self.conn.latency)
+        self.rows = cachedRows(self.conn.rows, self.conn.cols)
+        self.pos = 0
+        self.description = [(name, None, None, None, None, None, None) for name in columnNames(self.conn.cols)]
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        if self.conn.fetch_latency > 0:
+            time.sleep(self.conn.fetch_latency)
+        out = self.rows[self.pos:self.pos + size]
+        self.pos += len(out)
+        return out
+
+    def fetchall(self):
+        if self.conn.fetch_latency > 0:
+            time.sleep(self.conn.fetch_latency)
+        out = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return out
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        self.rows = []
+
+
+class FakeConnection(object):
+    # latency is seconds per execute, fetch_latency is seconds per fetchmany/fetchall call (a network round trip)
+    def __init__(self, rows=1000, cols=10, latency=0.0, fetch_latency=0.0):
+        self.rows = int(rows)
+        self.cols = int(cols)
+        self.latency = float(latency)
+        self.fetch_latency = float(fetch_latency)
+        self.executes = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+# An in memory SQLite database with a bench table of rows x cols. Every query runs against the real table,
+# so use a query like SELECT * FROM bench. check_same_thread is off since the pool hands connections to other threads
+def sqliteConnection(rows=1000, cols=10):
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    names = columnNames(cols)
+    conn.execute("CREATE TABLE bench (day TEXT, %s)" % ", ".join(names))
+    data = [("2020-01-01",) + row for row in cachedRows(rows, cols)]
+    conn.executemany("INSERT INTO bench VALUES (%s)" % ", ".join(["?"] * (cols + 1)), data)
+    conn.commit()
+    return conn
+
+
+# Hands out one underlying connection to every caller and ignores close, so a pool of these shares one SQLite database
+class SharedConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def close(self):
+        pass
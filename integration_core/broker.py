@@ -0,0 +1,495 @@
+#!/usr/bin/python
+
+# A shared query broker for hosts where many kernels query the same server (JupyterHub). Kernels with the _broker_socket
+# opt set send their queries to it over a Unix socket instead of connecting to the server themselves:
+# - Identical queries (same identity, connection and normalized text) that are already running are run once, and every
+#   kernel waiting on one gets the same result
+# - Results are written once as Arrow IPC files in result_dir, which kernels memory map. A result is served again for up
+#   to max_age seconds. result_dir can't be listed by kernels and result files have random names, so a kernel can only
+#   open the files whose names the broker sent it
+# - Connections to the server are pooled in the broker (one ConnectionPool per set of connection arguments)
+#
+# Results are scoped to the Unix user of the kernel (taken from the socket with SO_PEERCRED, not from anything the kernel
+# sends) plus its connection arguments, and are never served to another user. Who may run queries through the broker at
+# all is controlled by the permissions of the socket (--mode). Only read queries (SELECT, WITH, SHOW, DESCRIBE, EXPLAIN) are shared, anything else just runs on
+# a pooled connection. Requests and replies are one JSON object per line, result data never goes over the socket
+#
+# Start one with the connection opener of your integration, for example
+#   python -m integration_core.broker --socket /srv/jupyter/hive_broker.sock --opener jupyter_hive:Hive.openConnection
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import select
+import signal
+import hashlib
+import secrets
+import argparse
+import tempfile
+import importlib
+import threading
+import socketserver
+from collections import OrderedDict
+
+from integration_core.lazy_import import lazyModule
+from integration_core.connection_pool import ConnectionPool
+from integration_core.result_cache import normalizeQuery
+from integration_core.result_export import openResultWriter
+from integration_core.query_rules import ParsedQuery
+from integration_core.process_worker import workerDir
+from integration_core.execution import pollExecute
+
+pd = lazyModule('pandas')
+
+# Queries starting with one of these only read, so their results can be shared
+shared_words = ['select', 'with', 'show', 'describe', 'desc', 'explain']
+
+# Longest request line the broker reads, queries bigger than this are refused
+max_request = 16777216
+
+
+class BrokerError(Exception):
+    pass
+
+
+# The broker isn't running or can't be reached, callers can fall back to running the query themselves
+class BrokerUnavailable(BrokerError):
+    pass
+
+
+class BrokerCancelled(Exception):
+    pass
+
+
+def shareable(query):
+    toks = ParsedQuery(query).tokens
+    return len(toks) > 0 and toks[0].kind == 'ident' and toks[0].lower in shared_words
+
+
+# module:attribute spec (like the _rule_modules opt) of the callable that opens a connection from connection arguments
+def loadOpener(spec):
+    mod_name, sep, attr = spec.strip().partition(":")
+    obj = importlib.import_module(mod_name)
+    if sep != "":
+        for part in attr.split("."):
+            obj = getattr(obj, part)
+    return obj
+
+
+# One query being run by the broker, and everyone waiting on it
+class Flight(object):
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.cancel = threading.Event()
+        self.cursor = None
+        self.result = None
+        self.error = None
+        self.waiters = 1
+
+
+class Broker(object):
+    # open_connection is called with the connection arguments a kernel sends (see Integration.connectionArgs)
+    # Results older than max_age seconds are removed, as are the least recently used ones above max_bytes in total
+    # file_mode is given to result files, so kernels of other users that can use the socket can read them (by name, see main)
+    def __init__(self, open_connection, result_dir, max_age=300, max_bytes=4294967296, pool_max_size=4, pool_idle_timeout=600,
+                 ping_interval=60, ping_query="SELECT 1", batch_size=10000, poll_interval=0.5, file_mode=0o640):
+        self.open_connection = open_connection
+        self.result_dir = os.path.expanduser(result_dir)
+        self.max_age = float(max_age)
+        self.max_bytes = int(max_bytes)
+        self.pool_args = {'min_size': 0, 'max_size': pool_max_size, 'idle_timeout': pool_idle_timeout, 'ping_interval': ping_interval, 'ping_query': ping_query}
+        self.batch_size = int(batch_size)
+        self.poll_interval = float(poll_interval)
+        self.file_mode = file_mode
+        if not os.path.isdir(self.result_dir):
+            os.makedirs(self.result_dir)
+
+        self.lock = threading.Lock()
+        self.pools = {}                 # json of connection arguments -> ConnectionPool
+        self.flights = {}               # result key -> Flight, for shared queries that are running
+        self.results = OrderedDict()    # result key -> result, least recently used first
+        self.started = time.time()
+        self.stats = OrderedDict([('requests', 0), ('executed', 0), ('shared', 0), ('cached', 0), ('failed', 0), ('cancelled', 0)])
+
+    def resultKey(self, owner, conn_args, query):
+        scope = json.dumps([owner, conn_args], sort_keys=True)
+        return hashlib.sha256((scope + "\n" + normalizeQuery(query)).encode("utf-8")).hexdigest()
+
+    def getPool(self, conn_args):
+        pool_key = json.dumps(conn_args, sort_keys=True)
+        with self.lock:
+            pool = self.pools.get(pool_key)
+            if pool is None:
+                pool = ConnectionPool(lambda: self.open_connection(**conn_args), **self.pool_args)
+                self.pools[pool_key] = pool
+        return pool
+
+    # A stored result for key no older than max_age (and the broker's max_age), None if there isn't one. Call with lock held
+    def cached(self, key, max_age):
+        result = self.results.get(key)
+        if result is None or max_age <= 0:
+            return None
+        if time.time() - result['created'] > min(max_age, self.max_age):
+            return None
+        if result['path'] is not None and not os.path.exists(result['path']):
+            del self.results[key]
+            return None
+        self.results.move_to_end(key)
+        return result
+
+    # Drop expired results, then the least recently used until the rest fit in max_bytes. Call with lock held
+    # Kernels that already mapped a removed file keep their data, the memory is freed when they let go of it
+    def evict(self):
+        now = time.time()
+        total = sum(r['bytes'] for r in self.results.values())
+        for key in list(self.results.keys()):
+            result = self.results[key]
+            if now - result['created'] <= self.max_age and total <= self.max_bytes:
+                continue
+            del self.results[key]
+            total -= result['bytes']
+            if result['path'] is not None:
+                try:
+                    os.remove(result['path'])
+                except OSError:
+                    pass
+
+    # Returns the Flight to wait on (already done for a stored result) and how the result is served: executed, shared or cached
+    def submit(self, owner, conn_args, query, max_age):
+        share = shareable(query)
+        key = self.resultKey(owner, conn_args, query)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.evict()
+            if share:
+                result = self.cached(key, max_age)
+                if result is not None:
+                    self.stats['cached'] += 1
+                    flight = Flight(key)
+                    flight.result = result
+                    flight.done.set()
+                    return flight, "cached"
+                flight = self.flights.get(key)
+                if flight is not None and not flight.cancel.is_set():
+                    flight.waiters += 1
+                    self.stats['shared'] += 1
+                    return flight, "shared"
+            flight = Flight(key)
+            if share:
+                self.flights[key] = flight
+            self.stats['executed'] += 1
+        thread = threading.Thread(target=self.execute, args=(flight, conn_args, query, share), name="Broker query %s" % key[:12])
+        thread.daemon = True
+        thread.start()
+        return flight, "executed"
+
+    # A waiter gave up (cancelled, timed out or went away). Once nobody is waiting, the query is cancelled on the server
+    def leave(self, flight):
+        with self.lock:
+            flight.waiters -= 1
+            if flight.waiters > 0 or flight.done.is_set():
+                return
+            flight.cancel.set()
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            cursor = flight.cursor
+        if cursor is not None and hasattr(cursor, 'cancel'):
+            try:
+                cursor.cancel()
+            except Exception:
+                pass
+
+    def checkFlight(self, flight):
+        if flight.cancel.is_set():
+            raise BrokerCancelled("Cancelled")
+
+    def execute(self, flight, conn_args, query, share):
+        try:
+            with self.getPool(conn_args).connection() as conn:
+                self.checkFlight(flight)
+                cursor = conn.cursor()
+                flight.cursor = cursor
+                try:
+                    pollExecute(cursor, query, self.poll_interval, check=lambda: self.checkFlight(flight))
+                    flight.result = self.fetchResult(cursor, flight)
+                finally:
+                    flight.cursor = None
+                    cursor.close()
+        except Exception as e:
+            flight.error = str(e)
+        finally:
+            with self.lock:
+                if self.flights.get(flight.key) is flight:
+                    del self.flights[flight.key]
+                if flight.cancel.is_set():
+                    self.stats['cancelled'] += 1
+                elif flight.result is None:
+                    self.stats['failed'] += 1
+                if flight.result is not None:
+                    # Results of queries that aren't shared are stored under a key nobody asks for, so they are only cleaned up by evict
+                    store_key = flight.key if share else "%s:%s" % (flight.key, id(flight))
+                    old = self.results.get(store_key)
+                    if old is not None and old['path'] is not None:
+                        try:
+                            os.remove(old['path'])
+                        except OSError:
+                            pass
+                    self.results[store_key] = flight.result
+                    self.results.move_to_end(store_key)
+            flight.done.set()
+
+    # Fetch the result of the executed query on cursor into an Arrow IPC file in result_dir
+    def fetchResult(self, cursor, flight):
+        result = {'rows': 0, 'columns': None, 'path': None, 'bytes': 0, 'created': time.time()}
+        if cursor.description is None:
+            return result
+        columns = [col[0] for col in cursor.description]
+        result['columns'] = columns
+        # The name is the only thing keeping other users of the socket out of the result, so it must not be guessable
+        fd, tmp = tempfile.mkstemp(prefix="result_%s_" % secrets.token_hex(16), suffix=".arrow.tmp", dir=self.result_dir)
+        os.close(fd)
+        writer = None
+        try:
+            while True:
+                self.checkFlight(flight)
+                batch_rows = cursor.fetchmany(self.batch_size)
+                if not batch_rows:
+                    break
+                batch = pd.DataFrame.from_records(batch_rows, columns=columns, coerce_float=True)
+                if writer is None:
+                    writer = openResultWriter('arrow', tmp)
+                writer.write(batch)
+                result['rows'] += len(batch)
+            if writer is not None:
+                writer.close()
+                writer = None
+                path = tmp[:-len(".tmp")]
+                os.chmod(tmp, self.file_mode)
+                os.replace(tmp, path)
+                result['path'] = path
+                result['bytes'] = os.path.getsize(path)
+        finally:
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        result['created'] = time.time()
+        return result
+
+    def status(self):
+        with self.lock:
+            out = OrderedDict(self.stats)
+            out['running'] = len(self.flights)
+            out['results'] = len(self.results)
+            out['result_bytes'] = sum(r['bytes'] for r in self.results.values())
+            pools = list(self.pools.values())
+        connections = [p.status() for p in pools]
+        out['connections_idle'] = sum(c['idle'] for c in connections)
+        out['connections_in_use'] = sum(c['in_use'] for c in connections)
+        out['uptime'] = round(time.time() - self.started)
+        return out
+
+    # Cancel running queries, close the connections and remove every result file
+    def close(self):
+        with self.lock:
+            flights = list(self.flights.values())
+            self.flights = {}
+        for flight in flights:
+            flight.waiters = 0
+            flight.cancel.set()
+            if flight.cursor is not None and hasattr(flight.cursor, 'cancel'):
+                try:
+                    flight.cursor.cancel()
+                except Exception:
+                    pass
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+            self.max_age = -1
+            self.evict()
+            for fname in os.listdir(self.result_dir):
+                if fname.startswith("result_") and fname.endswith(".arrow.tmp"):
+                    try:
+                        os.remove(os.path.join(self.result_dir, fname))
+                    except OSError:
+                        pass
+
+    # Answer one request. sock is the client's socket, a client that goes away while waiting stops waiting on the query
+    # Queries are scoped to the uid of the process on the other end of sock
+    def handle(self, request, sock):
+        op = request.get('op', None)
+        uid = peerUid(sock)
+        if op == 'status':
+            return {'status': 'ok', 'stats': self.status(), 'uid': uid}
+        if op != 'query':
+            return {'status': 'error', 'message': "Unknown broker op %s" % op}
+        if uid is None:
+            return {'status': 'error', 'message': "The broker can't tell which user is connected (no SO_PEERCRED on this platform), so it runs no queries"}
+        conn_args = request.get('conn', None)
+        query = request.get('query', None)
+        if not isinstance(conn_args, dict) or not isinstance(query, str):
+            return {'status': 'error', 'message': "A query needs conn (connection arguments) and query"}
+        try:
+            max_age = float(request.get('max_age', self.max_age))
+        except (TypeError, ValueError):
+            return {'status': 'error', 'message': "max_age must be a number of seconds"}
+
+        flight, served = self.submit("uid:%s" % uid, conn_args, query, max_age)
+        while not flight.done.wait(self.poll_interval):
+            if clientGone(sock):
+                self.leave(flight)
+                return None
+        if flight.result is None:
+            return {'status': 'error', 'message': flight.error}
+        result = flight.result
+        return {'status': 'ok', 'served': served, 'rows': result['rows'], 'columns': result['columns'], 'path': result['path'],
+                'age': round(time.time() - result['created'], 3)}
+
+
+# The uid of the process on the other end of the Unix socket sock, None if the platform can't tell
+def peerUid(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    except OSError:
+        return None
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid
+
+
+# True if the other end of sock hung up (a client only ever sends one request, so anything readable is the hang up)
+def clientGone(sock):
+    try:
+        readable, writable, errored = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(max_request)
+        try:
+            request = json.loads(line.decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            reply = {'status': 'error', 'message': "Bad request: %s" % e}
+        else:
+            reply = self.server.broker.handle(request, self.connection)
+        if reply is not None:
+            try:
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            except OSError:
+                pass
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, broker, mode=0o660):
+        self.broker = broker
+        if os.path.exists(path):
+            # A socket left behind by a broker that died is removed, one that still answers is in use
+            try:
+                BrokerClient(path).request({'op': 'status'})
+            except BrokerError:
+                os.remove(path)
+            else:
+                raise BrokerError("A broker is already listening on %s" % path)
+        socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+        os.chmod(path, mode)
+
+
+# Used by kernels (see Integration.fetchFromBroker). Every request is its own connection to the broker
+class BrokerClient(object):
+    def __init__(self, path, poll_interval=0.5):
+        self.path = os.path.expanduser(path)
+        self.poll_interval = float(poll_interval)
+
+    # Send request and wait for the reply. check is called while waiting and can raise to give up. The connection is then
+    # closed, and the broker cancels the query on the server if no other kernel is waiting on it
+    # Raises BrokerUnavailable if the broker can't be reached and BrokerError for an error reply
+    def request(self, request, check=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                raise BrokerUnavailable("Broker at %s is not reachable: %s" % (self.path, e))
+            sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            data = b""
+            while not data.endswith(b"\n"):
+                if check is not None:
+                    check()
+                readable, writable, errored = select.select([sock], [], [], self.poll_interval)
+                if not readable:
+                    continue
+                chunk = sock.recv(65536)
+                if chunk == b"":
+                    raise BrokerError("The broker at %s closed the connection before replying" % self.path)
+                data += chunk
+        finally:
+            sock.close()
+        reply = json.loads(data.decode("utf-8"))
+        if reply.get('status') != 'ok':
+            raise BrokerError(reply.get('message', "Unknown broker error"))
+        return reply
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared query broker for Jupyter integration kernels on one host")
+    parser.add_argument("--socket", required=True, help="Unix socket to listen on, kernels set their _broker_socket opt to this")
+    parser.add_argument("--opener", required=True, help="module:attribute of the function opening a connection, e.g. jupyter_hive:Hive.openConnection")
+    parser.add_argument("--result-dir", default=None, help="Directory results are written to (default jupyter_broker in /dev/shm or the temp dir)")
+    parser.add_argument("--mode", default="660", help="Octal permissions of the socket, anyone who can use it can run queries through the broker (default 660)")
+    parser.add_argument("--max-age", type=float, default=300, help="Seconds results are kept and shared (default 300)")
+    parser.add_argument("--max-bytes", type=int, default=4294967296, help="Max total size of kept results (default 4 GB)")
+    parser.add_argument("--pool-max-size", type=int, default=4, help="Max connections open at once per set of connection arguments (default 4)")
+    parser.add_argument("--pool-idle-timeout", type=int, default=600, help="Seconds an idle connection is kept open (default 600)")
+    parser.add_argument("--ping-interval", type=int, default=60, help="Seconds between health checks of idle connections, 0 to disable (default 60)")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Rows fetched per fetchmany call (default 10000)")
+    args = parser.parse_args(argv)
+
+    mode = int(args.mode, 8)
+    result_dir = args.result_dir
+    if result_dir is None:
+        result_dir = os.path.join(workerDir(), "jupyter_broker")
+    broker = Broker(loadOpener(args.opener), result_dir, max_age=args.max_age, max_bytes=args.max_bytes, pool_max_size=args.pool_max_size,
+                    pool_idle_timeout=args.pool_idle_timeout, ping_interval=args.ping_interval, batch_size=args.batch_size, file_mode=mode & 0o644)
+    # Whoever can use the socket needs to be able to open the result files it is sent, but not to list the directory (and
+    # find other users' results) or change anything in it
+    dir_mode = 0o700
+    if mode & 0o060:
+        dir_mode |= 0o010
+    if mode & 0o006:
+        dir_mode |= 0o001
+    os.chmod(broker.result_dir, dir_mode)
+
+    server = BrokerServer(os.path.expanduser(args.socket), broker, mode)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print("Broker listening on %s, results in %s" % (args.socket, broker.result_dir))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        broker.close()
+        if os.path.exists(os.path.expanduser(args.socket)):
+            os.remove(os.path.expanduser(args.socket))
+
+
+if __name__ == "__main__":
+    main()
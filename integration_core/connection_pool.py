@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# Connection pool used by Integration so that queries don't each pay for a full handshake,
+# idle connections closed by the server are replaced transparently, and several queries
+# (async, batch) can run at once, each on its own connection.
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class ConnectionPool(object):
+    # factory is a callable with no arguments that returns a new DB-API connection
+    # min_size connections are opened right away (so bad credentials fail at connect time) and kept open by the keep-alive
+    # Connections idle longer than idle_timeout seconds (above min_size) are closed, 0 means never
+    # Connections idle longer than ping_interval seconds are checked with ping_query before being handed out, 0 means never check
+    def __init__(self, factory, min_size=1, max_size=4, idle_timeout=600, ping_interval=60, ping_query="SELECT 1"):
+        self.factory = factory
+        self.min_size = int(min_size)
+        self.max_size = max(int(max_size), 1)
+        self.idle_timeout = int(idle_timeout)
+        self.ping_interval = int(ping_interval)
+        self.ping_query = ping_query
+
+        self.idle = []       # List of [connection, last_used, last_checked] available to hand out, most recently used last (last_checked 0: check before use)
+        self.in_use = 0      # Number of connections currently checked out
+        self.created = 0     # Total connections opened over the life of the pool
+        self.reconnects = 0  # Connections replaced because they failed a health check
+        self.closed = False
+        self.cond = threading.Condition()
+
+        for x in range(min(self.min_size, self.max_size)):
+            self.idle.append([self.factory(), time.time(), time.time()])
+            self.created += 1
+
+        self.keepalive_thread = None
+        if self.ping_interval > 0:
+            self.keepalive_thread = threading.Thread(target=self.keepalive, name="ConnectionPool keep-alive")
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    # Run ping_query on conn, returns True if the connection is usable
+    def ping(self, conn):
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.ping_query)
+                if cursor.description is not None:
+                    cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def closeConnection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    # Check out a connection. Blocks until one is free if max_size connections are already in use
+    # timeout is in seconds (None waits forever). Raises RuntimeError if the pool is closed or on timeout
+    def acquire(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("Connection pool is closed")
+                if len(self.idle) > 0:
+                    conn, last_used, last_checked = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.in_use < self.max_size:
+                    conn, last_used, last_checked = None, None, None
+                    self.in_use += 1
+                    break
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("Timed out waiting for a free connection (%s in use)" % self.in_use)
+                    self.cond.wait(remaining)
+
+        # Open or health check the connection outside of the lock, this can take seconds
+        try:
+            if conn is not None:
+                now = time.time()
+                if self.idle_timeout > 0 and now - last_used > self.idle_timeout:
+                    self.closeConnection(conn)
+                    conn = None
+                elif (last_checked == 0 or (self.ping_interval > 0 and now - last_checked > self.ping_interval)) and not self.ping(conn):
+                    self.closeConnection(conn)
+                    conn = None
+                    with self.cond:
+                        self.reconnects += 1
+            if conn is None:
+                conn = self.factory()
+                with self.cond:
+                    self.created += 1
+        except:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+        return conn
+
+    # Return a connection to the pool. If broken is True the connection is closed instead of reused
+    # A suspect connection is health checked by acquire before it is handed out again (even with ping_interval 0)
+    # last_used is only passed by the keep-alive, so a ping doesn't count as use for idle_timeout
+    def release(self, conn, broken=False, last_used=None, suspect=False):
+        now = time.time()
+        if last_used is None:
+            last_used = now
+        with self.cond:
+            self.in_use -= 1
+            if broken or self.closed:
+                self.closeConnection(conn)
+            elif suspect:
+                self.idle.append([conn, last_used, 0])
+            else:
+                self.idle.append([conn, last_used, now])
+            self.cond.notify()
+
+    # with pool.connection() as conn: - releases the connection when done
+    # If the block raised one of discard (cancels, say) or an interrupt, the connection is closed. Any other error only marks
+    # it suspect, so it is checked on its next use instead of pinging here, which would hold up the error
+    @contextmanager
+    def connection(self, timeout=None, discard=()):
+        conn = self.acquire(timeout)
+        broken = False
+        suspect = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = isinstance(e, discard)
+            suspect = True
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken, suspect=suspect)
+
+    # Background thread: ping idle connections so the server doesn't drop them, and close
+    # connections above min_size that have been idle for more than idle_timeout
+    def keepalive(self):
+        while True:
+            time.sleep(self.ping_interval)
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.time()
+                check = []
+                keep = []
+                for item in self.idle:
+                    if self.idle_timeout > 0 and now - item[1] > self.idle_timeout and len(keep) + self.in_use >= self.min_size:
+                        self.closeConnection(item[0])
+                    elif now - item[2] > self.ping_interval:
+                        # Counted as in use while it is being checked so max_size is respected
+                        check.append(item)
+                        self.in_use += 1
+                    else:
+                        keep.append(item)
+                self.idle = keep
+            for conn, last_used, last_checked in check:
+                ok = self.ping(conn)
+                if not ok:
+                    with self.cond:
+                        self.reconnects += 1
+                self.release(conn, broken=not ok, last_used=last_used)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for conn, last_used, last_checked in self.idle:
+                self.closeConnection(conn)
+            self.idle = []
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return OrderedDict([('idle', len(self.idle)), ('in_use', self.in_use), ('max_size', self.max_size),
+                                ('created', self.created), ('reconnects', self.reconnects)])
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Running a statement on a cursor that can run it asynchronously on the server (pyhive), shared by the kernel
+# (Integration.executeCursor), worker processes and the broker
+import time
+
+
+# Raised inside a running query when it is cancelled or hits its timeout (or the server cancelled or closed the operation)
+class QueryCancelled(Exception):
+    pass
+
+
+# Raised when the server reports the operation failed. The message has the server's errorMessage="..." like pyhive's
+# errors do, so Integration.formatError shows just the server's message
+class QueryFailed(Exception):
+    pass
+
+
+# TOperationState values in TCLIService, for when it can't be imported
+fallback_states = {'INITIALIZED_STATE': 0, 'RUNNING_STATE': 1, 'FINISHED_STATE': 2, 'CANCELED_STATE': 3, 'CLOSED_STATE': 4,
+                   'ERROR_STATE': 5, 'UKNOWN_STATE': 6, 'PENDING_STATE': 7, 'TIMEDOUT_STATE': 8}
+
+
+# The value of the operation state called name. TCLIService comes with pyhive, so it is only imported here, once a
+# cursor that can poll is in use
+def operationState(name):
+    try:
+        from TCLIService.ttypes import TOperationState
+        return getattr(TOperationState, name)
+    except (ImportError, AttributeError):
+        return fallback_states[name]
+
+
+# Operation states that mean the server is still working
+def runningStates():
+    return [operationState('INITIALIZED_STATE'), operationState('RUNNING_STATE'), operationState('PENDING_STATE')]
+
+
+# Runs query on cursor without blocking and polls until the server has finished running it
+# check is called between polls and can raise to stop waiting (the caller cancels the operation)
+# If the operation didn't finish, QueryFailed (server error) or QueryCancelled (cancelled, closed or timed out on the
+# server) is raised, so a failed statement without a result set isn't taken for a success
+# Cursors that can't poll just run the query with execute
+def pollExecute(cursor, query, poll_interval, check=None):
+    if not hasattr(cursor, 'poll'):
+        cursor.execute(query)
+        return
+    running = runningStates()
+    cursor.execute(query, async_=True)
+    resp = cursor.poll()
+    while resp.operationState in running:
+        if check is not None:
+            check()
+        time.sleep(poll_interval)
+        resp = cursor.poll()
+    state = resp.operationState
+    if state == operationState('ERROR_STATE'):
+        raise QueryFailed("Query failed on the server: errorMessage=\"%s\"" % (getattr(resp, 'errorMessage', None) or "Unknown error"))
+    if state in (operationState('CANCELED_STATE'), operationState('CLOSED_STATE')):
+        raise QueryCancelled("Cancelled on the server")
+    if state == operationState('TIMEDOUT_STATE'):
+        raise QueryCancelled("Timed out on the server")
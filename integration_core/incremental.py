@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# Incremental queries. The result of a query is kept on local disk with a watermark, the largest value of its
+# partition column. The next run only asks the server for rows with column >= watermark, and those rows replace the
+# stored rows from the watermark on (so a partition that was still filling last time is fetched again in full).
+# Queries that group by the partition column work the same way, as long as the column is in the select list.
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from integration_core.lazy_import import lazyModule
+from integration_core.query_rules import ParsedQuery
+from integration_core.result_cache import normalizeQuery, writeFrame, readFrame
+
+pd = lazyModule('pandas')
+
+# Top level keywords that end a WHERE clause (or mark where one goes if there isn't one)
+clause_words = ['group', 'order', 'limit', 'having', 'sort', 'cluster', 'distribute', 'window']
+
+
+# SQL literal for a watermark value. Numbers are left bare, everything else (dates, timestamps, strings) is quoted
+def sqlLiteral(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'%s'" % str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+
+# Rewrite query so it only returns rows with column >= watermark. An existing top level WHERE becomes
+# WHERE column >= watermark AND (condition), otherwise a WHERE is added after the FROM clause
+def addLowerBound(query, column, watermark):
+    parsed = ParsedQuery(query)
+    toks = parsed.tokens
+    if parsed.has('union', top_level=True):
+        raise ValueError("Incremental mode can't rewrite UNION queries, filter each part on %s instead" % column)
+    bound = "%s >= %s" % (column, sqlLiteral(watermark))
+
+    where = parsed.find('where', top_level=True)
+    if where >= 0:
+        end = len(toks)
+        for i in range(where + 1, len(toks)):
+            if toks[i].depth == 0 and toks[i].kind == 'ident' and toks[i].lower in clause_words:
+                end = i
+                break
+        last = end - 1
+        while last > where and toks[last].kind == 'op' and toks[last].text == ';':
+            last -= 1
+        if last == where:
+            raise ValueError("Query has an empty WHERE clause")
+        # The condition ends at its last token, so a trailing comment can't swallow the closing parenthesis
+        cond_start = toks[where + 1].start
+        cond_end = toks[last].end
+        return query[:cond_start] + bound + " AND (" + query[cond_start:cond_end] + ")" + query[cond_end:]
+
+    start = parsed.find('from', top_level=True)
+    if start < 0:
+        raise ValueError("Incremental mode needs a query with a FROM clause")
+    for i in range(start + 1, len(toks)):
+        if toks[i].depth == 0 and toks[i].kind == 'ident' and toks[i].lower in clause_words:
+            return query[:toks[i].start] + "WHERE " + bound + "\n" + query[toks[i].start:]
+    trimmed = parsed.trimmed()
+    return trimmed + "\nWHERE " + bound + query[len(trimmed):]
+
+
+# pd_shrink_dtypes can turn the watermark column into an (unordered) category, which can't be compared or maxed
+def plainValues(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(series.cat.categories.dtype)
+    return series
+
+
+# Stored rows below watermark, then the newly fetched rows
+def mergeDelta(base, delta, column, watermark):
+    if base is None:
+        return delta.reset_index(drop=True)
+    keep = base[plainValues(base[column]) < watermark]
+    if len(delta) == 0:
+        return keep.reset_index(drop=True)
+    return pd.concat([keep, delta], ignore_index=True)
+
+
+# Largest non null value of column, as a plain Python value that can be saved as JSON
+def maxValue(df, column):
+    values = plainValues(df[column]).dropna()
+    if len(values) == 0:
+        return None
+    value = values.max()
+    if hasattr(value, 'item'):
+        try:
+            value = value.item()
+        except (ValueError, AttributeError):
+            pass
+    if not isinstance(value, (bool, int, float, str)):
+        value = str(value)
+    return value
+
+
+class IncrementalStore(object):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def key(self, query, identity="", column=""):
+        return hashlib.sha256((identity + "\n" + column + "\n" + normalizeQuery(query)).encode("utf-8")).hexdigest()
+
+    def statePath(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    # Returns the saved state and result for key, or None, None if there isn't one (or it can't be read)
+    def load(self, key):
+        with self.lock:
+            try:
+                with open(self.statePath(key)) as f:
+                    state = json.load(f, object_pairs_hook=OrderedDict)
+                df = readFrame(os.path.join(self.path, state['file']), state['format'])
+            except (IOError, OSError, ValueError, KeyError) as e:
+                if os.path.exists(self.statePath(key)):
+                    print("WARNING - Stored incremental result %s could not be read, running the full query: %s" % (key[:12], e))
+                return None, None
+            return state, df
+
+    # The result is written before the state, so a failed save leaves the previous state pointing at a complete file
+    def save(self, key, state, df):
+        with self.lock:
+            path, state['format'] = writeFrame(os.path.join(self.path, key), df)
+            fname = os.path.basename(path)
+            state['file'] = fname
+            tmp = self.statePath(key) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.statePath(key))
+            for other in [key + ".parquet", key + ".pkl"]:
+                if other != fname and os.path.exists(os.path.join(self.path, other)):
+                    os.remove(os.path.join(self.path, other))
+
+    # Remove stored results whose key starts with prefix (all of them if prefix is ""). Returns how many were removed
+    def remove(self, prefix=""):
+        removed = 0
+        with self.lock:
+            for fname in os.listdir(self.path):
+                if fname.find(prefix) == 0 and fname.endswith(".json"):
+                    key = fname[:-5]
+                    for ext in [".json", ".parquet", ".pkl"]:
+                        try:
+                            os.remove(os.path.join(self.path, key + ext))
+                        except OSError:
+                            pass
+                    removed += 1
+        return removed
+
+    def list(self):
+        out = []
+        with self.lock:
+            for fname in sorted(os.listdir(self.path)):
+                if not fname.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.path, fname)) as f:
+                        state = json.load(f, object_pairs_hook=OrderedDict)
+                except (IOError, OSError, ValueError):
+                    continue
+                out.append(OrderedDict([('id', fname[:12]), ('column', state.get('column', None)), ('watermark', state.get('watermark', None)),
+                                        ('rows', state.get('rows', None)), ('runs', state.get('runs', None)), ('updated', state.get('updated', None)),
+                                        ('query', state.get('query', ""))]))
+        return out
+
+
+def newState(query, column, watermark, rows, runs):
+    return OrderedDict([('query', " ".join(query.split())[:200]), ('column', column), ('watermark', watermark), ('rows', rows),
+                        ('runs', runs), ('updated', time.strftime("%Y-%m-%d %H:%M:%S"))])
@@ -5,41 +5,65 @@ import json
 import sys
 import os
 import time
-import pandas as pd
+import hashlib
+import tempfile
 from getpass import getpass
 from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from IPython.core.magic import (Magics, magics_class, line_magic, cell_magic, line_cell_magic)
 from IPython.core.display import HTML
 
+# Heavy imports are deferred until first use (see lazy_import) so importing the integration stays fast
+from integration_core.lazy_import import lazyModule
+pd = lazyModule('pandas')
+widgets = lazyModule('ipywidgets')
+
 # Your Specific integration imports go here, make sure they are in requirements! Examples left in for hive
-import requests
+# pyhive is only imported when the first connection is made
 import socket
-from pyhive import hive as hivemod
+requests = lazyModule('requests')
+hivemod = lazyModule('pyhive.hive')
+# The broker module also runs as the broker itself (python -m integration_core.broker), so it is only imported when used
+brokermod = lazyModule('integration_core.broker')
+
+from integration_core.connection_pool import ConnectionPool
+from integration_core.result_cache import ResultCache
+from integration_core.result_export import parseTarget, openResultWriter, loadResult, openResult, readHead
+from integration_core.paged_display import PagedTable
+from integration_core.query_rules import QueryValidator, ParsedQuery, importRules, entryPointRules
+from integration_core.query_history import QueryProfile, QueryHistory
+from integration_core.metadata_cache import MetadataCache, qualify
+from integration_core.incremental import IncrementalStore, addLowerBound, mergeDelta, maxValue, newState
+from integration_core.preview import previewQuery
+from integration_core.process_worker import ProcessWorker, WorkerError, workerDir
+from integration_core.execution import pollExecute, QueryCancelled
 
 
-# BeakerX integration is highly recommened, but at this time IS optional, so we TRY beakerx, and then fail well if its not there. 
-try:
-    from beakerx import *
-    from beakerx.object import beakerx
-except:
-    pass
+# BeakerX integration is highly recommened, but at this time IS optional. It is only imported when pd_use_beaker is
+# turned on (see loadBeaker), and we fail well if its not there.
 
 #import IPython.display
 from IPython.display import display_html, display, Javascript, FileLink, FileLinks, Image
-import ipywidgets as widgets
 
 @magics_class
 class Integration(Magics):
     # Static Variables
     ipy = None        # IPython variable for updating things
     session = None    # Session if ingeration uses it
+    pool = None       # ConnectionPool queries check connections out of
+    broker = None     # BrokerClient for the shared broker, if _broker_socket is set
     connected = False # Is the integration connected
     passwd = ""       # If the itegration uses a password, it's temp stored here
     last_query = ""
+    last_preview = None # The query (and options) of the last successful %%hive --preview, for %hive promote
+    last_row_count = 0 # Rows fetched by the last query, can be more than what is kept when streaming
+    last_run_text = None # The text the last query was sent to the server as (after rules like auto limit), None if it wasn't sent
     name_str = integration
 
     debug = False     # Enable debug mode
+    profile = False   # Print the timing breakdown of every query
 
     # Variables Dictionary
     opts = {}
@@ -54,10 +78,12 @@ class Integration(Magics):
     opts['pd_display.max_columns'] = [None, 'Max Columns']
     opts['pd_use_beaker'] = [False, 'Use the Beaker system for Pandas Display']
     opts['pd_beaker_bool_workaround'] = [True, 'Look for Dataframes with bool columns, and make it object for display in BeakerX']
+    opts['pd_display_paged'] = [False, 'Display results in a paged widget that only renders the current page (used instead of pd_display.max_rows when not using Beaker)']
+    opts['pd_page_size'] = [25, 'Number of rows per page when pd_display_paged is True']
+    opts['pd_shrink_dtypes'] = [False, 'Downcast numeric columns and store low cardinality string columns as category to cut the memory of results']
+    opts['pd_category_max_ratio'] = [0.5, 'With pd_shrink_dtypes, string columns with at most this ratio of unique values to rows become category']
 
-    pd.set_option('display.max_columns', opts['pd_display.max_columns'][0])
-    pd.set_option('display.max_rows', opts['pd_display.max_rows'][0])
-    pd.set_option('max_colwidth', opts['pd_max_colwidth'][0])
+    pd_options_set = False # The pd_ display options are applied to pandas the first time something is displayed
 
     # Get Env items (User and/or Base URL)
     try:
@@ -68,6 +94,10 @@ class Integration(Magics):
         turl = os.environ['JUPYTERHUB_' + name_str.upper() + '_BASE_URL']
     except:
         turl = ""
+    try:
+        tbroker = os.environ['JUPYTERHUB_' + name_str.upper() + '_BROKER_SOCKET']
+    except:
+        tbroker = ""
 
     # Hive specific variables as examples
     opts[name_str + '_max_rows'] = [1000, 'Max number of rows to return, will potentially add this to queries']
@@ -76,18 +106,107 @@ class Integration(Magics):
     opts[name_str + '_base_url_host'] = ["", "Hostname of connection derived from base_url"]
     opts[name_str + '_base_url_port'] = ["", "Port of connection derived from base_url"]
     opts[name_str + '_base_url_scheme'] = ["", "Scheme of connection derived from base_url"]
+    opts[name_str + '_verbose_errors'] = [False, "Show the full error returned by the server instead of just the errorMessage"]
+
+    # Query validation variables - see query_rules for the rules and how to add your own
+    opts[name_str + '_partition_col'] = ["day", "Partition column queries are expected to filter on (partition rule)"]
+    opts[name_str + '_auto_limit'] = [False, "Add LIMIT " + name_str + "_max_rows to queries without a limit instead of rejecting them"]
+    opts[name_str + '_rules_disabled'] = ["", "Comma separated names of query rules to skip (semicolon, partition, limit or your own)"]
+    opts[name_str + '_rule_modules'] = ["", "Comma separated module:attribute specs of extra query rules to load at startup"]
+
+    # Streaming fetch variables - pull results in batches with a cursor's fetchmany so memory depends on batch size, not result size
+    opts[name_str + '_stream_fetch'] = [False, "Fetch results in batches instead of one pd.read_sql call. Only " + name_str + "_max_rows rows are kept in prev_" + name_str]
+    opts[name_str + '_fetch_batch_size'] = [10000, "Number of rows to pull from the server per fetchmany call when streaming"]
+    opts[name_str + '_stream_spill_path'] = ["", "If set, every streamed batch is written to this file so the full result is kept on disk. Use parquet:path or arrow:path for columnar files (default csv)"]
+
+    # Async variables - run queries on a background thread so the kernel stays free
+    opts[name_str + '_async'] = [False, "Run %%" + name_str + " queries in the background by default (same as %%" + name_str + " --async)"]
+    opts[name_str + '_async_workers'] = [4, "Max number of async queries running at the same time"]
+
+    # Batch variables - %%hive --batch splits a cell into statements, --each=var runs the cell once per value in var
+    opts[name_str + '_batch_workers'] = [4, "Max number of batch queries running at the same time (each uses its own pooled connection)"]
+    opts[name_str + '_batch_combine'] = ["concat", "How batch results are put in prev_" + name_str + ": concat into one DataFrame, or dict of DataFrames keyed on value/statement"]
+
+    # Timeout variables - a timed out or interrupted query is cancelled on the server, not just abandoned
+    opts[name_str + '_query_timeout'] = [0, "Seconds a query may run before it is cancelled on the server, 0 for no timeout. Override per cell with --timeout=N"]
+    opts[name_str + '_poll_interval'] = [0.5, "Seconds between status checks of a running query (how quickly timeouts and cancels take effect)"]
+
+    # Connection pool variables - applied the next time you connect
+    opts[name_str + '_pool_min_size'] = [1, "Connections opened at connect time and kept open"]
+    opts[name_str + '_pool_max_size'] = [4, "Max number of connections open at once (queries wait for a free one above this)"]
+    opts[name_str + '_pool_idle_timeout'] = [600, "Seconds a connection above pool_min_size can sit idle before it is closed, 0 for never"]
+    opts[name_str + '_pool_ping_interval'] = [60, "Seconds between health checks of idle connections, dead ones are reconnected. 0 to disable"]
+    opts[name_str + '_pool_ping_query'] = ["SELECT 1", "Query used to check that a connection is still alive"]
+
+    # Result cache variables - results are kept on local disk, keyed on the query text and the user/url connected with
+    opts[name_str + '_cache'] = [False, "Check the local result cache before sending a query to the server, and cache new results"]
+    opts[name_str + '_cache_dir'] = [os.path.join("~", ".cache", "jupyter_" + name_str), "Directory cached results are stored in"]
+    opts[name_str + '_cache_ttl'] = [86400, "Seconds a cached result is used before it is fetched again, 0 for forever"]
+    opts[name_str + '_cache_max_bytes'] = [1073741824, "Max total size of the result cache on disk, least recently used results are dropped first"]
+
+    # Query history variables - every query is timed by phase and kept in %hive history
+    opts[name_str + '_history_size'] = [100, "Number of queries kept in the in memory query history"]
+    opts[name_str + '_history_log'] = ["", "If set, every query history record is also appended to this JSONL file"]
+
+    # Preview variables - %%hive --preview returns the first min(pd_display.max_rows, _max_rows) rows as fast as possible
+    opts[name_str + '_preview_sample'] = ["", "If set, --preview also samples the first table with TABLESAMPLE(this), e.g. 1 PERCENT or BUCKET 1 OUT OF 100 ON rand()"]
+
+    # Incremental variables - %%hive --incremental keeps results here and only fetches rows past the stored watermark
+    opts[name_str + '_incremental_dir'] = [os.path.join("~", ".local", "share", "jupyter_" + name_str, "incremental"), "Directory incremental query results and their watermarks are stored in"]
+
+    # Worker variables - %%hive --worker fetches and builds the result in a separate process with its own memory limit
+    opts[name_str + '_worker'] = [False, "Run every %%" + name_str + " query in a worker process (same as %%" + name_str + " --worker)"]
+    opts[name_str + '_worker_memory_mb'] = [4096, "Address space limit of a worker process in MB, a bigger result fails the worker and not the kernel. 0 for no limit"]
+    opts[name_str + '_worker_dir'] = ["", "Directory worker results are written to before the kernel maps them, /dev/shm if it exists when empty"]
+
+    # Broker variables - kernels on one host (JupyterHub) can send queries through a shared broker (python -m integration_core.broker)
+    # that runs identical queries once, shares recent results between kernels of the same Unix user and pools the connections
+    opts[name_str + '_broker_socket'] = [tbroker, "Unix socket of the shared query broker, queries go through it instead of straight to the server. Can be set via ENV Var: JUPYTERHUB_" + name_str.upper() + "_BROKER_SOCKET"]
+    opts[name_str + '_broker_max_age'] = [300, "Seconds old a result shared by the broker can be and still be used, 0 to always run the query (identical running queries are still shared)"]
+
+    # Metadata variables - databases, tables, columns and partitions are cached locally (in _cache_dir) for %hive tables/describe and tab completion
+    opts[name_str + '_meta_ttl'] = [3600, "Seconds cached metadata is used before it is fetched again, 0 for forever (%hive refresh forces it)"]
+    opts[name_str + '_meta_default_db'] = ["default", "Database used for table names without a database in %hive tables/describe/partitions and completion"]
+    opts[name_str + '_meta_preload'] = ["", "Comma separated databases whose tables and columns are loaded in the background when you connect"]
+    opts[name_str + '_meta_workers'] = [4, "Max number of DESCRIBE calls running at once when a whole database is loaded (never more than " + name_str + "_pool_max_size - 1)"]
+    opts[name_str + '_meta_columns_query'] = ["", "Optional query returning table, column, type rows for every table in {db} (e.g. from information_schema), used instead of one DESCRIBE per table"]
+    opts[name_str + '_meta_complete'] = [True, "Tab complete databases, tables and columns in %%" + name_str + " cells from the metadata cache (never waits on the server)"]
 
     # Class Init function - Obtain a reference to the get_ipython()
     def __init__(self, shell, pd_use_beaker=False, *args, **kwargs):
         super(Integration, self).__init__(shell)
         self.ipy = get_ipython()
         self.session = None
+        self.async_queries = OrderedDict() # id -> dict describing each background query
+        self.async_executor = None
+        self.async_lock = threading.Lock()
+        self.result_cache = None
+        self.cache_bypass = False
+        self.history = QueryHistory(self.opts[self.name_str + '_history_size'][0])
+        self.validator = None # Rules are loaded on first use, see getValidator
+        self.metadata = None # MetadataCache, made at connect time
+        self.meta_slots = None # Limits metadata queries to _pool_max_size - 1 pooled connections, made at connect time
+        self.incremental_store = None
+        self.registerCompleter()
         self.opts['pd_use_beaker'][0] = pd_use_beaker
         if pd_use_beaker == True:
-            try:
-                beakerx.pandas_display_table()
-            except:
-                print("WARNING - BEAKER SUPPORT FAILED")
+            self.loadBeaker()
+
+    # Imports beakerx and switches pandas display over to it. Only called when pd_use_beaker is turned on
+    def loadBeaker(self):
+        try:
+            from beakerx.object import beakerx
+            beakerx.pandas_display_table()
+        except:
+            print("WARNING - BEAKER SUPPORT FAILED")
+
+    # Apply the pd_ display options to pandas, done on first display so pandas isn't imported at startup
+    def applyPandasOptions(self):
+        if self.pd_options_set == False:
+            pd.set_option('display.max_columns', self.opts['pd_display.max_columns'][0])
+            pd.set_option('display.max_rows', int(self.opts['pd_display.max_rows'][0]))
+            pd.set_option('max_colwidth', int(self.opts['pd_max_colwidth'][0]))
+            self.pd_options_set = True
 
     def connect(self, prompt=False):
 
@@ -96,14 +215,14 @@ class Integration(Magics):
                 print("User not specified in JUPYTER_%s_USER or user override requested" % self.name_str.upper())
                 tuser = input("Please type user name if desired: ")
                 self.opts[self.name_str + '_user'][0] = tuser
-            print("Connecting as user %s" % self.opts[self.name_str'_user'][0])
+            print("Connecting as user %s" % self.opts[self.name_str + '_user'][0])
             print("")
 
-            if prompt == True or self.opts[self.name_str  + "_base_url'][0] == '':
+            if prompt == True or self.opts[self.name_str + '_base_url'][0] == '':
                 print("%s Base URL not specified in JUPYTER_%s_BASE_URL or override requested" % (self.name_str.capitalize(), self.name_str.upper()))
                 turl = input("Please type in the full %s URL: " % self.name_str.capitalize())
                 self.opts[self.name_str + '_base_url'][0] = turl
-            print("Connecting to %s URL: %s" % (self.name_str.capitalize(), self.opts['_base_url'][0]))
+            print("Connecting to %s URL: %s" % (self.name_str.capitalize(), self.opts[self.name_str + '_base_url'][0]))
             print("")
 
             myurl = self.opts[self.name_str + '_base_url'][0]
@@ -127,6 +246,7 @@ class Integration(Magics):
             if result == 0:
                 self.connected = True
                 print("%s - %s Connected!" % (self.name_str.capitalize(), self.opts[self.name_str + '_base_url'][0]))
+                self.startMetadata()
             else:
                 print("Connection Error - Perhaps Bad Usename/Password?")
 
@@ -138,20 +258,51 @@ class Integration(Magics):
 
     def disconnect(self):
         if self.connected == True:
-            print("Disconnected %s Session from %s" % (self.name_str.capitalize(), self.opts[self.name_str + '_base_url'][0])
+            print("Disconnected %s Session from %s" % (self.name_str.capitalize(), self.opts[self.name_str + '_base_url'][0]))
         else:
             print("%s Not Currently Connected - Resetting All Variables" % self.name_str.capitalize())
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = None
         self.session = None
         self.connected = False
 
 
 ##### Where we left off
+    # Opens one new connection to the server. The pool calls this whenever it needs a connection
+    def newConnection(self):
+        return self.openConnection(**self.connectionArgs())
+
+    # The arguments a connection is opened with. They are kept separate from openConnection so a worker process can
+    # open its own connection with them (everything in here has to be picklable)
+    def connectionArgs(self):
+        # To do, allow settings hive setting from ENV
+        return {'host': self.opts[self.name_str + '_base_url_host'][0], 'port': int(self.opts[self.name_str + '_base_url_port'][0]), 'username': self.opts[self.name_str + '_user'][0]}
+
+    # A classmethod, so worker processes can call it without the kernel's Integration instance
+    @classmethod
+    def openConnection(cls, **kwargs):
+        return hivemod.Connection(**kwargs)
+
     def auth(self):
         self.session = None
         result = -1
+        min_size = self.opts[self.name_str + '_pool_min_size'][0]
+        broker = self.getBroker()
+        if broker is not None:
+            # Queries go through the broker's connections, so the local pool (for fallback and serial batches) starts empty
+            try:
+                broker.request({'op': 'status'})
+                print("Queries will go through the broker at %s" % broker.path)
+                min_size = 0
+            except brokermod.BrokerError as e:
+                print("WARNING - %s, queries will connect directly" % e)
         try:
-            # To do, allow settings hive setting from ENV
-#            self.session = hivemod.Connection(host=self.opts['base_url_host'][0], port=self.opts['base_url_port'][0], username=self.opts['user'][0])
+            # Metadata loads (preload, refresh, a whole database of DESCRIBEs) always leave a connection free for queries
+            self.meta_slots = threading.BoundedSemaphore(max(int(self.opts[self.name_str + '_pool_max_size'][0]) - 1, 1))
+            self.pool = ConnectionPool(self.newConnection, min_size=min_size, max_size=self.opts[self.name_str + '_pool_max_size'][0],
+                                       idle_timeout=self.opts[self.name_str + '_pool_idle_timeout'][0], ping_interval=self.opts[self.name_str + '_pool_ping_interval'][0],
+                                       ping_query=self.opts[self.name_str + '_pool_ping_query'][0])
             result = 0
         except:
             print("%s Connection Error!" % self.name_str.capitalize())
@@ -159,78 +310,1104 @@ class Integration(Magics):
         return result
 
 
-    def validateQuery(self, query):
-        bRun = True
+    # Loads the query rules: the defaults, then <name>_rule_modules, then any installed jupyter_<name>.query_rules entry points
+    def loadRules(self):
+        self.validator = QueryValidator()
+        for rule in entryPointRules("jupyter_%s.query_rules" % self.name_str):
+            self.validator.register(rule)
+        for spec in str(self.opts[self.name_str + '_rule_modules'][0]).split(","):
+            if spec.strip() == "":
+                continue
+            try:
+                for rule in importRules(spec):
+                    self.validator.register(rule)
+            except Exception as e:
+                print("WARNING - Could not load query rules from %s: %s" % (spec, e))
+
+    def getValidator(self):
+        if self.validator is None:
+            self.loadRules()
+        return self.validator
+
+    # Add a query_rules.Rule (class or instance). A rule with the same name as an existing one replaces it
+    def registerRule(self, rule):
+        self.getValidator().register(rule)
+
+    # Runs the query rules and returns whether to run, and the query to run (rules like auto limit can rewrite it)
+    # rerun can be passed in when the caller tracks reruns itself (batches track the whole cell, not each statement)
+    def prepareQuery(self, query, rerun=None):
         bReRun = False
-        if self.last_query == query:
+        if rerun is not None:
+            bReRun = rerun
+        elif self.last_query == query:
             # If the validation allows rerun, that we are here:
             bReRun = True
-        # Ok, we know if we are rerun or not, so let's now set the last_query 
-        self.last_query = query
-        
-        # Example Validation
-
-        # Warn only - Don't change bRun
-        # This one is looking for a ; in the query. We let it run, but we warn the user
-        # Basically, we print a warning but don't change the bRun variable and the bReRun doesn't matter
-        if query.find(";") >= 0:
-            print("WARNING - Do not type a trailing semi colon on queries, your query will fail (like it probably did here)")
-
-        # Warn and don't submit after first attempt - Second attempt go ahead and run
-        # If the query doesn't have a day query, then maybe we want to WARN the user and not run the query.
-        # However, if this is the second time in a row that the user has submitted the query, then they must want to run without day
-        # So if bReRun is True, we allow bRun to stay true. This ensures the user to submit after warnings
-        if query.lower().find("day = ") < 0:
-            print("WARNING - Queries shoud have day = component to ensure you don't have to many map tasks")
-            if bReRun == False:
-                print("First Submission - Not Sending to Server - Run again to submit as is")
-                bRun = False
+        # Ok, we know if we are rerun or not, so let's now set the last_query
+        if rerun is None:
+            self.last_query = query
+
+        disabled = [x.strip() for x in str(self.opts[self.name_str + '_rules_disabled'][0]).split(",") if x.strip() != ""]
+        return self.getValidator().validate(query, self, rerun=bReRun, disabled=disabled)
+
+    def validateQuery(self, query):
+        return self.prepareQuery(query)[0]
+
+    def listRules(self):
+        disabled = [x.strip() for x in str(self.opts[self.name_str + '_rules_disabled'][0]).split(",") if x.strip() != ""]
+        print("{: <20} {: <10} {: <10} {: <80}".format(*["Rule", "Severity", "Enabled", "Message"]))
+        for rule in self.getValidator().rules:
+            print("{: <20} {: <10} {: <10} {: <80}".format(*[rule.name, rule.severity, str(rule.name not in disabled), rule.message]))
+
+    def formatError(self, e):
+        str_err = str(e)
+        if self.opts[self.name_str + '_verbose_errors'][0] == True:
+            status = "Failure - query_error: " + str_err
+        else:
+            msg_find = "errorMessage=\""
+            em_start = str_err.find(msg_find)
+            if em_start < 0:
+                # Not a server error (a connection or worker error, for example), so there is no errorMessage to pull out
+                str_out = str_err
             else:
-                print("Query will be submitted ")
-        # Warn and do not allow submission
-        # There is no way for a user to submit this query 
-        if query.lower().find('limit ") < 0:
-            print("ERROR - All queries must have a limit clause - Query will not submit without out")
-            bRun = False
-        return bRun
+                find_len = len(msg_find)
+                em_end = str_err[em_start + find_len:].find("\"")
+                str_out = str_err[em_start + find_len:em_start + em_end + find_len]
+            status = "Failure - query_error: " + str_out
+        return status
+
+    # A control is the dict a running query checks for cancellation. Async jobs are controls too
+    # deadline is the time.time() after which the query is cancelled (None for no timeout)
+    # on_check, if set, is called every time the query checks its control: between polls while the server runs it (or while
+    # waiting on a worker or the broker) and between fetched batches, so progress can be shown while nothing comes back
+    def newControl(self, timeout=None):
+        if timeout is None:
+            timeout = self.opts[self.name_str + '_query_timeout'][0]
+        control = {'cancel': threading.Event(), 'reason': None, 'deadline': None}
+        self.setTimeout(control, timeout)
+        return control
+
+    def setTimeout(self, control, timeout):
+        if timeout is not None and float(timeout) > 0:
+            control['timeout'] = float(timeout)
+            control['deadline'] = time.time() + float(timeout)
+
+    def checkControl(self, control):
+        if control is None:
+            return
+        if control.get('on_check') is not None:
+            control['on_check']()
+        if control['cancel'].is_set():
+            raise QueryCancelled(control.get('reason') or "Cancelled")
+        if control.get('deadline') is not None and time.time() > control['deadline']:
+            raise QueryCancelled("Timed out after %s seconds" % control['timeout'])
+
+    # Tell the server to stop the operation running on cursor. Errors are ignored, the cursor may already be done
+    def cancelCursor(self, cursor):
+        if hasattr(cursor, 'cancel'):
+            try:
+                cursor.cancel()
+            except Exception:
+                pass
+
+    # Runs query on cursor, returning once the server has results ready
+    # Cursors that can poll (pyhive) run the statement asynchronously on the server and are polled here, so a timeout,
+    # a cancel of control, or a KeyboardInterrupt cancels the operation on the server instead of leaving it running
+    # Other DB-API cursors block in execute, for those a timer calls cursor.cancel() (if the driver has it) at the deadline
+    def executeCursor(self, cursor, query, control=None):
+        if not hasattr(cursor, 'poll'):
+            timer = None
+            if control is not None and control.get('deadline') is not None:
+                timer = threading.Timer(max(control['deadline'] - time.time(), 0), self.cancelCursor, [cursor])
+                timer.daemon = True
+                timer.start()
+            try:
+                cursor.execute(query)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            self.checkControl(control)
+            return
+
+        pollExecute(cursor, query, float(self.opts[self.name_str + '_poll_interval'][0]), check=lambda: self.checkControl(control))
+
+    # Generator that runs query on a cursor of conn and yields DataFrames of at most batch_size rows
+    # Nothing is yielded if the query returns no result set. Closing the generator early closes the cursor
+    # Time spent is added to the execute, first_row, fetch and frame phases of profile
+    # If the query is cancelled (control, timeout or KeyboardInterrupt) it is cancelled on the server before the error is raised
+    def fetchBatches(self, conn, query, batch_size=None, profile=None, control=None):
+        if batch_size is None:
+            batch_size = int(self.opts[self.name_str + '_fetch_batch_size'][0])
+        if profile is None:
+            profile = QueryProfile(query)
+        cursor = conn.cursor()
+        try:
+            with profile.phase('execute'):
+                self.executeCursor(cursor, query, control)
+            if cursor.description is None:
+                return
+            columns = [col[0] for col in cursor.description]
+            fetch_phase = 'first_row'
+            while True:
+                with profile.phase(fetch_phase):
+                    rows = cursor.fetchmany(batch_size)
+                fetch_phase = 'fetch'
+                if not rows:
+                    break
+                with profile.phase('frame'):
+                    batch = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+                yield batch
+                self.checkControl(control)
+        except (QueryCancelled, KeyboardInterrupt):
+            self.cancelCursor(cursor)
+            raise
+        finally:
+            cursor.close()
+
+    # Fetches the whole result at once, the same way pd.read_sql does, but with each phase timed
+    # Returns None if the query returns no result set
+    def fetchAll(self, conn, query, profile=None, control=None):
+        if profile is None:
+            profile = QueryProfile(query)
+        cursor = conn.cursor()
+        try:
+            with profile.phase('execute'):
+                self.executeCursor(cursor, query, control)
+            if cursor.description is None:
+                return None
+            columns = [col[0] for col in cursor.description]
+            with profile.phase('fetch'):
+                rows = cursor.fetchall()
+            with profile.phase('frame'):
+                return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        except (QueryCancelled, KeyboardInterrupt):
+            self.cancelCursor(cursor)
+            raise
+        finally:
+            cursor.close()
+
+    # Streams query results, keeping at most keep_rows rows in memory (defaults to _max_rows)
+    # Every batch is handed to callback (if given) - if the callback returns False, fetching stops early
+    # If spill_path is set, every batch is also written there (csv, parquet or arrow, see result_export) so the full result is available on disk
+    # Returns the bounded preview DataFrame (None if no result set) and the total number of rows fetched
+    def streamQuery(self, conn, query, callback=None, keep_rows=None, spill_path=None, profile=None, control=None):
+        if keep_rows is None:
+            keep_rows = int(self.opts[self.name_str + '_max_rows'][0])
+        if spill_path is None:
+            spill_path = self.opts[self.name_str + '_stream_spill_path'][0]
+        if profile is None:
+            profile = QueryProfile(query)
+
+        preview = []
+        kept = 0
+        total = 0
+        got_results = False
+        spill_writer = None
+        batches = self.fetchBatches(conn, query, profile=profile, control=control)
+        try:
+            for batch in batches:
+                if got_results == False:
+                    got_results = True
+                    preview.append(batch.iloc[0:0])
+                    if spill_path != "":
+                        spill_writer = openResultWriter(*parseTarget(spill_path))
+                total += len(batch)
+                if spill_writer is not None:
+                    with profile.phase('spill'):
+                        spill_writer.write(batch)
+                if kept < keep_rows:
+                    keep = batch.iloc[:keep_rows - kept]
+                    preview.append(keep)
+                    kept += len(keep)
+                if callback is not None and callback(batch) is False:
+                    break
+        finally:
+            batches.close()
+            if spill_writer is not None:
+                with profile.phase('spill'):
+                    spill_writer.close()
 
-    def runQuery(self, query):
+        if got_results == False:
+            return None, 0
+        with profile.phase('frame'):
+            return pd.concat(preview, ignore_index=True), total
 
+    # Sends an already validated query to the server on a pooled connection (or conn, if given). Safe to call from a background thread
+    # control (see newControl) lets another thread cancel the query, if not given one is made with the _query_timeout opt
+    # With worker, the query runs in a worker process instead (see fetchInWorker) and on_rows is called with the running row count
+    # With _broker_socket set, queries without a conn or spill file go through the shared broker (see fetchFromBroker)
+    # Returns the DataFrame (None if no results or failure), the number of rows fetched, and the status
+    def executeQuery(self, query, stream=False, callback=None, keep_rows=None, spill_path=None, profile=None, control=None, conn=None, worker=False, on_rows=None):
         mydf = None
-        status = "-"
-        starttime = int(time.time())
-        run_query = self.validateQuery(query)
-        if run_query:
-            if self.connected == True:
-                try:
-                    mydf = pd.read_sql(query, self.session)
-                    status = "Success"
-                except (TypeError):
-                    status = "Success - No Results"
-                    mydf = None
-                except Exception as e:
-                    str_err = str(e)
-                    if self.opts['verbose_errors'][0] == True:
-                        status = "Failure - query_error: " + str_err
+        row_count = 0
+        if profile is None:
+            profile = QueryProfile(query)
+        if control is None:
+            control = self.newControl()
+        if self.connected == True:
+            try:
+                fetch_args = {'stream': stream, 'callback': callback, 'keep_rows': keep_rows, 'spill_path': spill_path, 'profile': profile, 'control': control}
+                via_broker = False
+                if conn is None and (spill_path is None or spill_path == "") and not (stream == True and self.opts[self.name_str + '_stream_spill_path'][0] != "") and self.getBroker() is not None:
+                    # The broker already keeps the result out of the kernel, so with worker only _max_rows rows are built here
+                    # like in fetchInWorker, the full result goes to prev_<name>_arrow
+                    broker_rows = keep_rows
+                    if broker_rows is None and (stream == True or worker == True):
+                        broker_rows = int(self.opts[self.name_str + '_max_rows'][0])
+                    try:
+                        mydf, row_count = self.fetchFromBroker(query, keep_rows=broker_rows, profile=profile, control=control)
+                        via_broker = True
+                    except brokermod.BrokerUnavailable as e:
+                        print("WARNING - %s, running the query directly" % e)
+                if via_broker == False:
+                    if worker == True:
+                        if profile.mode == "sync":
+                            profile.mode = "worker"
+                        mydf, row_count = self.fetchInWorker(query, keep_rows=keep_rows, spill_path=spill_path, profile=profile, control=control, on_rows=on_rows)
+                    elif conn is None:
+                        acquire_start = time.perf_counter()
+                        acquire_timeout = None
+                        if control.get('deadline') is not None:
+                            acquire_timeout = max(control['deadline'] - time.time(), 0)
+                        with self.pool.connection(acquire_timeout, discard=(QueryCancelled,)) as pooled_conn:
+                            profile.add('acquire', time.perf_counter() - acquire_start)
+                            mydf, row_count = self.fetchOnConnection(pooled_conn, query, **fetch_args)
                     else:
-                        msg_find = "errorMessage=\""
-                        em_start = str_err.find(msg_find)
-                        find_len = len(msg_find)
-                        em_end = str_err[em_start + find_len:].find("\"")
-                        str_out = str_err[em_start + find_len:em_start + em_end + find_len]
-                        status = "Failure - query_error: " + str_out
+                        mydf, row_count = self.fetchOnConnection(conn, query, **fetch_args)
+                if mydf is None:
+                    status = "Success - No Results"
+                else:
+                    status = "Success"
+            except QueryCancelled as e:
+                status = "Failure - Cancelled: %s (the query was cancelled on the server)" % e
+            except KeyboardInterrupt:
+                status = "Failure - Cancelled: Interrupted (the query was cancelled on the server)"
+            except Exception as e:
+                status = self.formatError(e)
+        else:
+            status = "%s Not Connected" % self.name_str.capitalize()
+        if mydf is not None:
+            with profile.phase('frame'):
+                mydf = self.postFetch(mydf)
+        return mydf, row_count, status
+
+    def fetchOnConnection(self, conn, query, stream=False, callback=None, keep_rows=None, spill_path=None, profile=None, control=None):
+        if stream == True:
+            return self.streamQuery(conn, query, callback=callback, keep_rows=keep_rows, spill_path=spill_path, profile=profile, control=control)
+        mydf = self.fetchAll(conn, query, profile=profile, control=control)
+        if mydf is None:
+            return None, 0
+        return mydf, len(mydf)
+
+    # Runs query in a worker process (see process_worker) with its own connection and a _worker_memory_mb memory limit, so
+    # a result too big for memory fails the worker instead of killing the kernel, and the kernel never builds the full result
+    # The worker writes Arrow IPC to _worker_dir (/dev/shm by default), which is memory mapped here without a copy. The first
+    # keep_rows (default _max_rows) rows are returned, and the full result is put in prev_<name>_arrow (see attachArrow)
+    # With spill_path (or _stream_spill_path) the worker writes that file instead, and it is kept
+    # Returns the DataFrame (None if no result set) and the total number of rows
+    def fetchInWorker(self, query, keep_rows=None, spill_path=None, profile=None, control=None, on_rows=None):
+        if keep_rows is None:
+            keep_rows = int(self.opts[self.name_str + '_max_rows'][0])
+        if spill_path is None:
+            spill_path = self.opts[self.name_str + '_stream_spill_path'][0]
+        if profile is None:
+            profile = QueryProfile(query)
+
+        temp = spill_path == ""
+        if temp:
+            fmt = 'arrow'
+            fd, path = tempfile.mkstemp(prefix="jupyter_" + self.name_str + "_", suffix=".arrow", dir=workerDir(self.opts[self.name_str + '_worker_dir'][0]))
+            os.close(fd)
+        else:
+            fmt, path = parseTarget(spill_path)
+        worker = ProcessWorker(type(self).openConnection, self.connectionArgs(), query, fmt, path, batch_size=self.opts[self.name_str + '_fetch_batch_size'][0],
+                               memory_mb=self.opts[self.name_str + '_worker_memory_mb'][0], poll_interval=self.opts[self.name_str + '_poll_interval'][0])
+        try:
+            worker.start()
+            msg = worker.wait(check=lambda: self.checkControl(control), on_rows=on_rows)
+            if msg[0] == 'cancelled':
+                raise QueryCancelled(msg[1])
+            if msg[0] == 'error':
+                raise WorkerError(msg[1])
+            rows, columns, phases = msg[1], msg[2], msg[3]
+            for phase, seconds in phases.items():
+                profile.add(phase, seconds)
+            if columns is None:
+                return None, 0
+            if rows == 0:
+                return pd.DataFrame(columns=columns), 0
+            with profile.phase('frame'):
+                if fmt != 'arrow':
+                    return readHead(fmt + ":" + path, keep_rows), rows
+                # The mapping stays valid after the file is removed, the memory is freed when the table is
+                return self.attachArrow(path, keep_rows), rows
+        finally:
+            worker.stop()
+            if temp and os.path.exists(path):
+                os.remove(path)
+
+    def getBroker(self):
+        path = self.opts[self.name_str + '_broker_socket'][0]
+        if path is None or path == "":
+            self.broker = None
+        elif self.broker is None or self.broker.path != os.path.expanduser(path):
+            self.broker = brokermod.BrokerClient(path, poll_interval=self.opts[self.name_str + '_poll_interval'][0])
+        return self.broker
+
+    # Runs query through the shared broker (see broker). If a kernel of the same Unix user (the broker checks the socket's
+    # peer, the kernel can't claim to be someone else) with the same connection arguments is already running the query, its
+    # result is used, as is a result up to max_age (default _broker_max_age) seconds old. Cancelling stops waiting, and the broker cancels the
+    # query on the server once no kernel is waiting on it
+    # The result is memory mapped from the broker's Arrow file. Only keep_rows rows (all of them if None) are built as a
+    # DataFrame, when rows are cut the full result is put in prev_<name>_arrow as an Arrow Table
+    # Returns the DataFrame (None if no result set) and the total number of rows. Raises BrokerUnavailable if the broker can't be
+    # reached, or if it evicted the result file before it could be mapped here (the caller then runs the query itself)
+    def fetchFromBroker(self, query, keep_rows=None, profile=None, control=None, max_age=None):
+        if profile is None:
+            profile = QueryProfile(query)
+        if max_age is None:
+            max_age = self.opts[self.name_str + '_broker_max_age'][0]
+        request = {'op': 'query', 'conn': self.connectionArgs(), 'query': query, 'max_age': float(max_age)}
+        broker_mode = profile.mode == "sync"
+        if broker_mode:
+            profile.mode = "broker"
+        with profile.phase('execute'):
+            reply = self.getBroker().request(request, check=lambda: self.checkControl(control))
+        if broker_mode:
+            profile.mode = "broker " + reply['served']
+        if reply['columns'] is None:
+            return None, 0
+        if reply['rows'] == 0:
+            return pd.DataFrame(columns=reply['columns']), 0
+        with profile.phase('frame'):
+            try:
+                return self.attachArrow(reply['path'], keep_rows), reply['rows']
+            except FileNotFoundError:
+                raise brokermod.BrokerUnavailable("The broker removed the result before it was read")
+
+    # Memory map an Arrow result file and build a DataFrame of its first keep_rows rows (all of them if None). When rows are
+    # cut, the full table is put in prev_<name>_arrow and the DataFrame's attrs['full_result'] names it
+    def attachArrow(self, path, keep_rows=None):
+        table = loadResult("arrow:" + path)
+        if keep_rows is None or keep_rows >= table.num_rows:
+            return table.to_pandas()
+        arrow_var = 'prev_' + self.name_str + '_arrow'
+        self.ipy.user_ns[arrow_var] = table
+        mydf = table.slice(0, keep_rows).to_pandas()
+        mydf.attrs['full_result'] = arrow_var
+        return mydf
+
+    # %hive broker - the shared broker's counters
+    def brokerCommand(self):
+        broker = self.getBroker()
+        if broker is None:
+            print("No broker set, use %%%s set %s_broker_socket %%path%%" % (self.name_str, self.name_str))
+            return
+        try:
+            reply = broker.request({'op': 'status'})
+        except brokermod.BrokerError as e:
+            print("Error: %s" % e)
+            return
+        stats = reply['stats']
+        print("{: <30} {: <50}".format(*["Broker Socket:", broker.path]))
+        print("{: <30} {: <50}".format(*["Broker Identity:", "uid %s" % reply.get('uid')]))
+        for k, v in stats.items():
+            print("{: <30} {: <50}".format(*[k.replace("_", " ").capitalize() + ":", str(v)]))
+
+    # Post fetch stage, applied once to every result before it is stored in prev_<name> (or cached)
+    # Columns are converted in place on the result, nothing here copies the whole frame
+    def postFetch(self, mydf):
+        if self.opts['pd_shrink_dtypes'][0] == True and len(mydf) > 0:
+            max_ratio = float(self.opts['pd_category_max_ratio'][0])
+            for col in mydf.select_dtypes(include=['integer']).columns:
+                mydf[col] = pd.to_numeric(mydf[col], downcast='integer')
+            for col in mydf.select_dtypes(include=['floating']).columns:
+                mydf[col] = pd.to_numeric(mydf[col], downcast='float')
+            for col in mydf.select_dtypes(include=['object', 'string']).columns:
+                if mydf[col].nunique(dropna=True) <= len(mydf) * max_ratio:
+                    mydf[col] = mydf[col].astype('category')
+        return mydf
+
+    # Display stage, applied only to the rows actually shown (a page, or the rows under pd_display.max_rows)
+    # Returns a display copy of those rows, so the BeakerX and CRLF fixes never touch prev_<name>
+    def prepareDisplay(self, display_df):
+        bool_fix = self.opts['pd_use_beaker'][0] == True and self.opts['pd_beaker_bool_workaround'][0] == True
+        crlf_fix = self.opts['pd_replace_crlf'][0] == True
+        if bool_fix == False and crlf_fix == False:
+            return display_df
+        display_df = display_df.copy()
+        if bool_fix:
+            bool_cols = display_df.select_dtypes(include=['bool']).columns
+            if len(bool_cols) > 0:
+                display_df[bool_cols] = display_df[bool_cols].astype(object)
+        if crlf_fix:
+            str_cols = display_df.select_dtypes(include=['object', 'string', 'category']).columns
+            if len(str_cols) > 0:
+                # The replacements are regex templates, so the backslash is escaped to show up literally
+                display_df[str_cols] = display_df[str_cols].astype(object).replace({"\r": r"\\r", "\n": r"\\n"}, regex=True)
+        return display_df
+
+    # Returns the ResultCache to use, or None if caching is off
+    def getCache(self, use_cache=None):
+        if use_cache is None:
+            use_cache = self.opts[self.name_str + '_cache'][0]
+        if use_cache != True:
+            return None
+        cache_dir = os.path.expanduser(self.opts[self.name_str + '_cache_dir'][0])
+        if self.result_cache is None or self.result_cache.path != cache_dir:
+            self.result_cache = ResultCache(cache_dir)
+        self.result_cache.ttl = int(self.opts[self.name_str + '_cache_ttl'][0])
+        self.result_cache.max_bytes = int(self.opts[self.name_str + '_cache_max_bytes'][0])
+        return self.result_cache
+
+    def cacheKey(self, cache, query):
+        return cache.key(query, "%s@%s" % (self.opts[self.name_str + '_user'][0], self.opts[self.name_str + '_base_url'][0]))
+
+    # Only complete results are cached, a streamed result that was cut down to _max_rows is not
+    def cacheResult(self, cache, query, mydf, row_count):
+        if cache is not None and mydf is not None and row_count == len(mydf):
+            try:
+                cache.put(self.cacheKey(cache, query), mydf, query)
+            except Exception as e:
+                print("WARNING - Could not cache result: %s" % e)
+
+    # %hive cache status|clear|bypass
+    def cacheCommand(self, line):
+        cmd = line.strip().lower()
+        if cmd == "bypass":
+            self.cache_bypass = True
+            print("The next query will skip the result cache and refresh its cached result")
+            return
+        cache = self.getCache(True)
+        if cmd == "clear":
+            cache.clear()
+            print("Result cache at %s cleared" % cache.path)
+        elif cmd == "status" or cmd == "":
+            print("{: <30} {: <50}".format(*["Cache Enabled:", str(self.opts[self.name_str + '_cache'][0])]))
+            for k, v in cache.status().items():
+                print("{: <30} {: <50}".format(*[k.replace("_", " ").capitalize() + ":", str(v)]))
+        else:
+            print("Unknown cache command %s - use %%%s cache status|clear|bypass" % (cmd, self.name_str))
+
+    # %hive load path [var] - path is format:path or a path ending in .parquet/.arrow
+    def loadCommand(self, line):
+        parts = line.strip().split()
+        if len(parts) == 0:
+            print("Usage: %%%s load %%path%% %%var%%" % self.name_str)
+            return
+        var = 'prev_' + self.name_str
+        if len(parts) > 1:
+            var = parts[1]
+        try:
+            result = openResult(parts[0])
+        except Exception as e:
+            print("Error loading %s: %s" % (parts[0], e))
+            return
+        self.ipy.user_ns[var] = result
+        if hasattr(result, 'iter_batches'):
+            print("%s Records in %s row groups opened from %s as %s, nothing is read yet - use %s.read(columns=[...]).to_pandas() or %s.iter_batches()" % (result.metadata.num_rows, result.num_row_groups, parts[0], var, var, var))
+        else:
+            print("%s Records memory mapped from %s into %s - use %s.to_pandas() for a DataFrame" % (result.num_rows, parts[0], var, var))
+
+    # Runs a catalog query (SHOW, DESCRIBE) on a pooled connection and returns the rows
+    # These are internal, so they skip the query rules, the result cache and the history
+    def metaQuery(self, query):
+        if self.connected != True or self.pool is None:
+            raise Exception("%s Not Connected" % self.name_str.capitalize())
+        control = self.newControl()
+        if self.getBroker() is not None:
+            # A reload (%hive refresh, an expired entry) has to see the current catalog, not a result the broker kept
+            max_age = None
+            if self.metadata is not None and self.metadata.reloading():
+                max_age = 0
+            try:
+                mydf, row_count = self.fetchFromBroker(query, control=control, max_age=max_age)
+                if mydf is None:
+                    return []
+                return list(mydf.itertuples(index=False, name=None))
+            except brokermod.BrokerUnavailable:
+                pass
+        with self.meta_slots:
+            with self.pool.connection(discard=(QueryCancelled,)) as conn:
+                cursor = conn.cursor()
+                try:
+                    self.executeCursor(cursor, query, control)
+                    if cursor.description is None:
+                        return []
+                    return cursor.fetchall()
+                except (QueryCancelled, KeyboardInterrupt):
+                    self.cancelCursor(cursor)
+                    raise
+                finally:
+                    cursor.close()
+
+    # Metadata loaders used by the MetadataCache. These are the Hive versions, change the queries and parsing for your integration
+    # Tables are always db.table, and names are kept lower case like the Hive metastore does
+    def metaDatabases(self):
+        return [str(r[0]).lower() for r in self.metaQuery("SHOW DATABASES")]
+
+    def metaTables(self, db):
+        return [str(r[0]).lower() for r in self.metaQuery("SHOW TABLES IN `%s`" % db)]
+
+    # DESCRIBE lists the columns, then for partitioned tables a "# Partition Information" section repeating the partition columns
+    # Returns a list of [column, type, comment, is_partition_column]
+    def metaColumns(self, table):
+        db, sep, name = table.partition(".")
+        columns = []
+        in_partitions = False
+        for row in self.metaQuery("DESCRIBE `%s`.`%s`" % (db, name)):
+            col = str(row[0] or "").strip()
+            if col.find("# Partition Information") == 0:
+                in_partitions = True
+                continue
+            if col == "" or col.find("#") == 0:
+                continue
+            if in_partitions:
+                for c in columns:
+                    if c[0] == col:
+                        c[3] = True
             else:
-                mydf = None
-                status = "%d Not Connected" % self.name_str.capitalize()
+                columns.append([col, str(row[1] or "").strip(), str(row[2] or "").strip(), False])
+        return columns
+
+    def metaPartitions(self, table):
+        db, sep, name = table.partition(".")
+        return [str(r[0]) for r in self.metaQuery("SHOW PARTITIONS `%s`.`%s`" % (db, name))]
+
+    # With _meta_columns_query set, the columns of every table in db come back from one query instead of a DESCRIBE per table
+    def metaBulkColumns(self, db):
+        query = self.opts[self.name_str + '_meta_columns_query'][0]
+        if query is None or query == "":
+            return None
+        tables = {}
+        for row in self.metaQuery(query.replace("{db}", db)):
+            tables.setdefault(str(row[0]).lower(), []).append([str(row[1]).lower(), str(row[2]), "", False])
+        return tables
 
+    # Make the metadata cache for the connected user and URL (loading what was saved there last time) and start any preloads
+    def startMetadata(self):
+        cache_dir = os.path.expanduser(self.opts[self.name_str + '_cache_dir'][0])
+        identity = "%s@%s" % (self.opts[self.name_str + '_user'][0], self.opts[self.name_str + '_base_url'][0])
+        path = os.path.join(cache_dir, "metadata_%s.json" % hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16])
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError as e:
+            print("WARNING - Metadata will not be saved between sessions, could not create %s: %s" % (cache_dir, e))
+            path = None
+        loaders = {'databases': self.metaDatabases, 'tables': self.metaTables, 'columns': self.metaColumns,
+                   'partitions': self.metaPartitions, 'bulk_columns': self.metaBulkColumns}
+        self.metadata = MetadataCache(loaders, path)
+        self.getMetadata()
+        for db in str(self.opts[self.name_str + '_meta_preload'][0]).split(","):
+            if db.strip() != "":
+                self.metadata.refresh(db.strip().lower())
+
+    # Returns the MetadataCache with the current opts applied, or None if there has been no connection yet
+    def getMetadata(self):
+        if self.metadata is not None:
+            self.metadata.ttl = int(self.opts[self.name_str + '_meta_ttl'][0])
+            self.metadata.workers = max(int(self.opts[self.name_str + '_meta_workers'][0]), 1)
+        return self.metadata
+
+    # %hive databases|tables [db]|describe [db.]table|partitions [db.]table|refresh [db|db.table]
+    # Answers come from the metadata cache, only missing or expired entries go to the server. Listings are returned as DataFrames
+    def metaCommand(self, cmd, arg):
+        meta = self.getMetadata()
+        if meta is None:
+            print(self.name_str.capitalize() + " is not connected: Please see help at %" + self.name_str)
+            return None
+        default_db = str(self.opts[self.name_str + '_meta_default_db'][0]).lower()
+        arg = arg.strip().replace("`", "").lower()
+        if cmd in ['describe', 'partitions'] and arg == "":
+            print("Usage: %%%s %s [database.]table" % (self.name_str, cmd))
+            return None
+        try:
+            if cmd == "databases":
+                return pd.DataFrame({'database': meta.get('databases')})
+            elif cmd == "tables":
+                if arg == "":
+                    arg = default_db
+                return pd.DataFrame({'table': meta.get('tables', arg)})
+            elif cmd == "describe":
+                return pd.DataFrame(meta.get('columns', qualify(arg, default_db)), columns=['column', 'type', 'comment', 'partition_column'])
+            elif cmd == "partitions":
+                return pd.DataFrame({'partition': meta.get('partitions', qualify(arg, default_db))})
+            elif cmd == "refresh":
+                names = [arg]
+                if arg == "":
+                    names = ["", default_db]
+                for name in names:
+                    meta.refresh(name)
+                print("Refreshing metadata for %s in the background" % ", ".join([n if n != "" else "the database list" for n in names]))
+        except Exception as e:
+            print("Error: %s" % self.formatError(e))
+        return None
+
+    # Completions for token in a %%hive cell (or a %hive line), from the metadata cache only
+    def metaCompletions(self, token, text):
+        meta = self.getMetadata()
+        if meta is None or self.opts[self.name_str + '_meta_complete'][0] != True:
+            return []
+        text = text.lstrip()
+        if text.find("%%" + self.name_str) == 0:
+            query = text.partition("\n")[2]
+        elif text.find("%" + self.name_str + " ") == 0:
+            query = ""
         else:
-            status = "ValidationError"
-            mydf = None
-        endtime = int(time.time())
-        query_time = endtime - starttime
+            return []
+        return meta.complete(token, query, str(self.opts[self.name_str + '_meta_default_db'][0]).lower())
+
+    # Add metadata completion to the IPython completer. IPython 8.6+ passes matchers the whole cell, so %%hive cells are completed
+    # anywhere in the cell. Older versions only see the current line, so there only %hive lines and the %%hive line itself are completed
+    def registerCompleter(self):
+        completer = getattr(self.ipy, 'Completer', None)
+        if completer is None:
+            return
+        identifier = "jupyter_%s.metadata" % self.name_str
+        try:
+            from IPython.core.completer import context_matcher, SimpleCompletion
+
+            def matcher(context):
+                matches = self.metaCompletions(context.token, context.full_text)
+                return {'completions': [SimpleCompletion(m, type=self.name_str) for m in matches], 'suppress': len(matches) > 0}
+            matcher = context_matcher(identifier=identifier)(matcher)
+        except ImportError:
+            def matcher(text):
+                return self.metaCompletions(text, completer.line_buffer)
+            matcher.matcher_identifier = identifier
+        # Reloading the extension replaces the old matcher instead of adding a second one
+        completer.custom_matchers[:] = [m for m in completer.custom_matchers if getattr(m, 'matcher_identifier', None) != identifier]
+        completer.custom_matchers.append(matcher)
+
+    # Record a finished query in the history (and the JSONL log), printing its timing if profiling is on
+    def finishProfile(self, profile, status, rows=0, mydf=None):
+        profile.finish(status, rows, mydf, deep=self.profile)
+        self.history.resize(self.opts[self.name_str + '_history_size'][0])
+        self.history.log_path = self.opts[self.name_str + '_history_log'][0]
+        self.history.add(profile)
+        if self.profile == True and profile.mode != "async":
+            print("Profile - %s" % profile.summary())
+
+    # If profile is passed in, the caller is responsible for calling finishProfile (so it can time rendering too)
+    def runQuery(self, query, stream=None, callback=None, use_cache=None, spill_path=None, profile=None, timeout=None, worker=None):
+
+        mydf = None
+        status = "-"
+        self.last_row_count = 0
+        self.last_run_text = None
+        if stream is None:
+            stream = self.opts[self.name_str + '_stream_fetch'][0]
+        if worker is None:
+            worker = self.opts[self.name_str + '_worker'][0]
+        finish = False
+        if profile is None:
+            profile = QueryProfile(query)
+            finish = True
+        # A cached result already passed validation when it was fetched, so the cache is checked first
+        cache = self.getCache(use_cache)
+        if cache is not None and self.cache_bypass == False:
+            mydf = cache.get(self.cacheKey(cache, query))
+        self.cache_bypass = False
+        if mydf is not None:
+            self.last_row_count = len(mydf)
+            status = "Success - Cached"
+        else:
+            with profile.phase('validate'):
+                run_query, run_text = self.prepareQuery(query)
+            if run_query:
+                self.last_run_text = run_text
+                mydf, self.last_row_count, status = self.executeQuery(run_text, stream=stream, callback=callback, spill_path=spill_path, profile=profile, control=self.newControl(timeout), worker=worker)
+                self.cacheResult(cache, query, mydf, self.last_row_count)
+            else:
+                status = "ValidationError"
+                mydf = None
+        query_time = round(profile.elapsed(), 2)
+        if finish == True:
+            self.finishProfile(profile, status, self.last_row_count, mydf)
 
         return mydf, query_time, status
 
+    # %%hive --preview. The query's LIMIT is pushed down to rows (default min(pd_display.max_rows, _max_rows)), and with
+    # _preview_sample set the first table is sampled, so a first look comes back in seconds instead of after a full scan
+    # A reduced result is returned with status "Success - Preview" and result.attrs['preview'] describing what was done
+    def runPreview(self, query, rows=True, use_cache=None, profile=None, timeout=None):
+        self.last_row_count = 0
+        if rows == True:
+            rows = min(int(self.opts['pd_display.max_rows'][0]), int(self.opts[self.name_str + '_max_rows'][0]))
+        try:
+            rows = max(int(rows), 1)
+        except ValueError:
+            return None, 0, "Failure - --preview=%s is not a number of rows" % rows
+        run_text, note = previewQuery(query, rows, self.opts[self.name_str + '_preview_sample'][0])
+        if self.debug:
+            print("Preview query: %s" % run_text)
+        mydf, qtime, status = self.runQuery(run_text, use_cache=use_cache, profile=profile, timeout=timeout, worker=False)
+        if status.find("Success") == 0:
+            self.last_preview = {'query': query, 'timeout': timeout}
+        # A cached preview is still a preview
+        if mydf is not None and status.find("Success") == 0 and note != "":
+            mydf.attrs['preview'] = note
+            status = "Success - Preview"
+        return mydf, qtime, status
+
+    # %hive promote - run the full query of the last preview as an async query
+    def promotePreview(self):
+        if self.last_preview is None:
+            print("No preview to promote - run a query with %%%s --preview first" % self.name_str)
+            return
+        if self.connected != True:
+            print(self.name_str.capitalize() + " is not connected: Please see help at %" + self.name_str)
+            return
+        # The preview already went through the confirm rules, so the full query isn't held back as a first submission
+        job_id = self.runQueryAsync(self.last_preview['query'], timeout=self.last_preview['timeout'], rerun=True)
+        if job_id is not None:
+            print("Submitted the full query as async query %s - results will be placed in prev_%s. Cancel with %%%s cancel %s" % (job_id, self.name_str, self.name_str, job_id))
+
+    def getIncrementalStore(self):
+        inc_dir = os.path.expanduser(self.opts[self.name_str + '_incremental_dir'][0])
+        if self.incremental_store is None or self.incremental_store.path != inc_dir:
+            self.incremental_store = IncrementalStore(inc_dir)
+        return self.incremental_store
+
+    # Runs query in incremental mode (%%hive --incremental). The first run fetches everything and stores the result with
+    # a watermark, the max of column (default _partition_col). Later runs only fetch column >= watermark and merge those rows
+    # into the stored result. full=True refetches everything. Returns the merged result, like runQuery
+    def runIncremental(self, query, column=None, full=False, profile=None, timeout=None):
+        if column is None:
+            column = str(self.opts[self.name_str + '_partition_col'][0])
+        # t.day can be used to filter a join, the result column is still day
+        result_col = column.split(".")[-1].replace("`", "")
+        store = self.getIncrementalStore()
+        key = store.key(query, "%s@%s" % (self.opts[self.name_str + '_user'][0], self.opts[self.name_str + '_base_url'][0]), column)
+        state, base = None, None
+        if full == False:
+            state, base = store.load(key)
+        if state is not None and state['watermark'] is None:
+            state, base = None, None
+        run_text = query
+        if state is not None:
+            try:
+                run_text = addLowerBound(query, column, state['watermark'])
+            except ValueError as e:
+                return None, 0, "Failure - %s" % e
+            print("Incremental - %s rows stored up to %s = %s, fetching %s >= %s" % (len(base), result_col, state['watermark'], column, state['watermark']))
+            if self.debug:
+                print("Incremental query: %s" % run_text)
+
+        # Every fetched row is merged into the stored result, so they have to come back to the kernel (not streamed, not in a worker)
+        delta, qtime, status = self.runQuery(run_text, stream=False, use_cache=False, profile=profile, timeout=timeout, worker=False)
+        if status.find("Success") != 0:
+            return delta, qtime, status
+        if delta is not None and self.last_row_count > len(delta):
+            return None, qtime, "Failure - Only %s of %s rows came back, nothing was stored (an incremental result has to be complete)" % (len(delta), self.last_row_count)
+        if delta is None:
+            if state is None:
+                return delta, qtime, status
+            delta = base.iloc[0:0]
+        if result_col not in delta.columns:
+            print("WARNING - %s is not in the results, add it to the select list to run this query incrementally. Nothing was stored" % result_col)
+            return delta, qtime, status
+        fetched = len(delta)
+        # The LIMIT of what was sent (auto limit adds one during validation). Rows it cut off may be below the new watermark,
+        # and later runs never fetch those again, so a result that reached it isn't stored either
+        limit = None
+        if self.last_run_text is not None:
+            limit = ParsedQuery(self.last_run_text).limit()
+        if limit is not None and fetched >= limit:
+            return None, qtime, "Failure - %s rows were fetched, the LIMIT %s may have cut off rows, nothing was stored (raise the LIMIT or narrow the query)" % (fetched, limit)
+        merged = mergeDelta(base, delta, result_col, state['watermark'] if state is not None else None)
+        watermark = maxValue(merged, result_col)
+        runs = 1 if state is None else state.get('runs', 1) + 1
+        try:
+            store.save(key, newState(query, column, watermark, len(merged), runs), merged)
+        except Exception as e:
+            print("WARNING - Could not store the incremental result: %s" % e)
+        if state is not None:
+            print("Incremental - fetched %s rows, %s rows now stored up to %s = %s" % (fetched, len(merged), result_col, watermark))
+        self.last_row_count = len(merged)
+        return merged, qtime, status
+
+    # %hive incremental [list] | %hive incremental clear [id]
+    def incrementalCommand(self, line):
+        parts = line.strip().split()
+        store = self.getIncrementalStore()
+        if len(parts) == 0 or parts[0].lower() == "list":
+            return pd.DataFrame(store.list(), columns=['id', 'column', 'watermark', 'rows', 'runs', 'updated', 'query'])
+        elif parts[0].lower() == "clear":
+            prefix = ""
+            if len(parts) > 1:
+                prefix = parts[1]
+            print("Removed %s stored incremental results" % store.remove(prefix))
+        else:
+            print("Unknown incremental command %s - use %%%s incremental list|clear [id]" % (parts[0], self.name_str))
+        return None
+
+    # Turns a %%hive --batch / --each=var cell into a list of keys and queries
+    # --batch splits the cell into statements (keys are statement numbers from 1)
+    # --each=var runs the cell once for every value in the notebook variable var, replacing {var} with the value
+    # If a value is a dict, each {key} in the cell is replaced by its value instead. Returns None, None on error
+    def expandBatch(self, cell, cell_args):
+        statements = [cell]
+        if cell_args.get('batch', False) == True:
+            statements = ParsedQuery(cell).statements()
+        each = cell_args.get('each', True)
+        if each == True:
+            return list(range(1, len(statements) + 1)), statements
+        try:
+            values = list(self.ipy.user_ns[each])
+        except KeyError:
+            print("Error: --each=%s but there is no variable named %s in the notebook" % (each, each))
+            return None, None
+        except TypeError:
+            print("Error: --each=%s but %s is not a list of values" % (each, each))
+            return None, None
+        keys = []
+        queries = []
+        for value in values:
+            if isinstance(value, dict):
+                key = tuple(value.values())
+                subs = value
+            else:
+                key = value
+                subs = {each: value}
+            for n, stmt in enumerate(statements):
+                for k, v in subs.items():
+                    stmt = stmt.replace("{" + str(k) + "}", str(v))
+                if len(statements) > 1:
+                    keys.append((key, n + 1))
+                else:
+                    keys.append(key)
+                queries.append(stmt)
+        return keys, queries
+
+    # Runs a batch of queries, up to _batch_workers at once (or in order on one connection with serial, for scripts that
+    # rely on session state like SET or USE). All queries are validated first, and nothing runs if any fails validation
+    # Returns the combined result (a DataFrame for concat, an OrderedDict of key -> DataFrame for dict) and the statuses
+    def runBatch(self, keys, queries, stream=None, workers=None, combine=None, serial=False, timeout=None, rerun=False):
+        if stream is None:
+            stream = self.opts[self.name_str + '_stream_fetch'][0]
+        if workers is None:
+            workers = self.opts[self.name_str + '_batch_workers'][0]
+        if combine is None:
+            combine = self.opts[self.name_str + '_batch_combine'][0]
+        workers = max(int(workers), 1)
+
+        profiles = []
+        run_texts = []
+        for key, query in zip(keys, queries):
+            profile = QueryProfile(query, mode="batch")
+            with profile.phase('validate'):
+                run_query, run_text = self.prepareQuery(query, rerun=rerun)
+            if run_query == False:
+                print("Batch not submitted - query %s failed validation" % (key,))
+                return None, None
+            profiles.append(profile)
+            run_texts.append(run_text)
+
+        controls = [self.newControl(timeout) for x in queries]
+        results = [None] * len(queries)
+        starttime = time.perf_counter()
+
+        def finished(idx):
+            mydf, row_count, status = results[idx]
+            self.finishProfile(profiles[idx], status, row_count, mydf)
+            print("[%s/%s] %s: %s - %s rows in %.2f seconds" % (len([r for r in results if r is not None]), len(queries), keys[idx], status, row_count, profiles[idx].elapsed()))
+
+        if serial == True:
+            try:
+                with self.pool.connection(discard=(QueryCancelled,)) as conn:
+                    for idx in range(len(queries)):
+                        results[idx] = self.executeQuery(run_texts[idx], stream=stream, profile=profiles[idx], control=controls[idx], conn=conn)
+                        finished(idx)
+                        if results[idx][2].find("Failure") == 0:
+                            print("Stopping batch after a failure")
+                            break
+            except Exception as e:
+                print("Error: %s" % self.formatError(e))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = {}
+            for idx in range(len(queries)):
+                fut = executor.submit(self.executeQuery, run_texts[idx], stream=stream, profile=profiles[idx], control=controls[idx])
+                futures[fut] = idx
+            try:
+                for fut in as_completed(futures):
+                    idx = futures[fut]
+                    results[idx] = fut.result()
+                    finished(idx)
+            except KeyboardInterrupt:
+                # Running queries are cancelled on the server by their own threads, queued ones never start
+                for fut in futures:
+                    fut.cancel()
+                for control in controls:
+                    control['reason'] = "Batch interrupted"
+                    control['cancel'].set()
+                print("Batch interrupted - cancelling running queries")
+            executor.shutdown(wait=True)
+
+        frames = [(keys[idx], results[idx][0]) for idx in range(len(queries)) if results[idx] is not None and results[idx][0] is not None]
+        statuses = [(keys[idx], results[idx][2] if results[idx] is not None else "Not Run") for idx in range(len(queries))]
+        failed = len([x for x in statuses if x[1].find("Success") != 0])
+        rows = sum(len(df) for key, df in frames)
+        print("Batch of %s queries: %s succeeded, %s failed or not run, %s rows in %.2f seconds" % (len(queries), len(queries) - failed, failed, rows, time.perf_counter() - starttime))
+        if len(frames) == 0:
+            return None, statuses
+        if combine == "dict":
+            return OrderedDict(frames), statuses
+        return pd.concat([df for key, df in frames], ignore_index=True), statuses
+
+    # Validates query in the foreground, then runs it on a background thread and returns the job id right away
+    # Results are always streamed so the job can report progress and be cancelled between batches
+    # When the job finishes, the result is put in prev_<name> (if it succeeded)
+    def runQueryAsync(self, query, stream=None, use_cache=None, spill_path=None, timeout=None, rerun=None, worker=None):
+        if stream is None:
+            stream = self.opts[self.name_str + '_stream_fetch'][0]
+        if worker is None:
+            worker = self.opts[self.name_str + '_worker'][0]
+        cache = self.getCache(use_cache)
+        bypass = self.cache_bypass
+        self.cache_bypass = False
+        if cache is not None and bypass == False:
+            mydf = cache.get(self.cacheKey(cache, query))
+            if mydf is not None:
+                self.ipy.user_ns['prev_' + self.name_str] = mydf
+                print("%s Records from the result cache placed in prev_%s" % (len(mydf), self.name_str))
+                return None
+        profile = QueryProfile(query, mode="async")
+        with profile.phase('validate'):
+            run_query, run_text = self.prepareQuery(query, rerun=rerun)
+        if run_query == False:
+            return None
+
+        if self.async_executor is None:
+            self.async_executor = ThreadPoolExecutor(max_workers=int(self.opts[self.name_str + '_async_workers'][0]))
+        with self.async_lock:
+            job_id = len(self.async_queries) + 1
+            job = self.newControl(timeout)
+            job.update({'id': job_id, 'query': query, 'status': "Queued", 'rows': 0, 'starttime': time.time(), 'endtime': None,
+                        'future': None, 'widget': None, 'cache': cache, 'spill_path': spill_path, 'worker': worker})
+            self.async_queries[job_id] = job
+        job['widget'] = self.asyncWidget(job)
+        display(job['widget'])
+        # A worker keeps the full result in prev_<name>_arrow, so like streaming only _max_rows rows are built in the kernel
+        if stream == True or worker == True:
+            keep_rows = None
+        else:
+            keep_rows = sys.maxsize
+        job['run_text'] = run_text
+        job['profile'] = profile
+        job['future'] = self.async_executor.submit(self.asyncWorker, job, keep_rows)
+        return job_id
+
+    def asyncWorker(self, job, keep_rows):
+        if job['cancel'].is_set():
+            return
+        job['status'] = "Running"
+        self.asyncUpdate(job)
+
+        # Cancels are picked up by executeQuery through the job (it is the query's control)
+        def progress(batch):
+            job['rows'] += len(batch)
+            self.asyncUpdate(job)
+
+        def workerProgress(rows):
+            job['rows'] = rows
+            self.asyncUpdate(job)
+
+        # Keeps the elapsed time moving while the server is still executing and no rows have come back
+        job['on_check'] = lambda: self.asyncUpdate(job)
+
+        # The timeout counts from when the query starts running, not from when it was queued
+        if job.get('timeout') is not None:
+            self.setTimeout(job, job['timeout'])
+        mydf, row_count, status = self.executeQuery(job['run_text'], stream=True, callback=progress, keep_rows=keep_rows, spill_path=job['spill_path'], profile=job['profile'], control=job,
+                                                    worker=job['worker'], on_rows=workerProgress)
+        job['endtime'] = time.time()
+        job['rows'] = row_count
+        if job['cancel'].is_set():
+            job['status'] = "Cancelled"
+            self.finishProfile(job['profile'], "Cancelled", row_count, mydf)
+        else:
+            self.finishProfile(job['profile'], status, row_count, mydf)
+            job['status'] = status
+            self.cacheResult(job['cache'], job['query'], mydf, row_count)
+            if mydf is not None:
+                self.ipy.user_ns['prev_' + self.name_str] = mydf
+                if row_count > len(mydf) and 'full_result' in mydf.attrs:
+                    job['status'] = "Success - First %s rows kept in prev_%s, all %s in %s" % (len(mydf), self.name_str, row_count, mydf.attrs['full_result'])
+                elif row_count > len(mydf):
+                    job['status'] = "Success - First %s rows kept in prev_%s" % (len(mydf), self.name_str)
+                else:
+                    job['status'] = "Success - Results in prev_%s" % self.name_str
+        self.asyncUpdate(job)
+
+    def asyncWidget(self, job):
+        label = widgets.HTML()
+        button = widgets.Button(description="Cancel", button_style="warning")
+        button.on_click(lambda b: self.cancelQuery(job['id']))
+        box = widgets.HBox([label, button])
+        box.label = label
+        box.button = button
+        self.asyncUpdate(job, box)
+        return box
+
+    def asyncUpdate(self, job, box=None):
+        if box is None:
+            box = job['widget']
+        if box is None:
+            return
+        if job['endtime'] is None:
+            elapsed = time.time() - job['starttime']
+        else:
+            elapsed = job['endtime'] - job['starttime']
+            box.button.disabled = True
+        box.label.value = "<b>%s query %s</b>: %s - %s rows - %.1f seconds" % (self.name_str.capitalize(), job['id'], job['status'], job['rows'], elapsed)
+
+    def cancelQuery(self, job_id):
+        try:
+            job = self.async_queries[int(job_id)]
+        except:
+            print("No async query with id %s - see %%%s jobs" % (job_id, self.name_str))
+            return
+        if job['endtime'] is not None:
+            print("Async query %s already finished: %s" % (job['id'], job['status']))
+            return
+        job['reason'] = "Cancelled by user"
+        job['cancel'].set()
+        if job['future'] is not None and job['future'].cancel():
+            # Never started, so the worker will not update it
+            job['status'] = "Cancelled"
+            job['endtime'] = time.time()
+        else:
+            job['status'] = "Cancelling"
+        self.asyncUpdate(job)
+        print("Cancel requested for async query %s" % job['id'])
+
+    def listQueries(self):
+        print("{: <6} {: <50} {: <12} {: <10} {: <50}".format(*["Id", "Query", "Rows", "Seconds", "Status"]))
+        for job_id, job in self.async_queries.items():
+            if job['endtime'] is None:
+                elapsed = time.time() - job['starttime']
+            else:
+                elapsed = job['endtime'] - job['starttime']
+            q = " ".join(job['query'].split())
+            if len(q) > 47:
+                q = q[:47] + "..."
+            print("{: <6} {: <50} {: <12} {: <10} {: <50}".format(*[job_id, q, job['rows'], "%.1f" % elapsed, job['status']]))
+
+    # Parse arguments on the %%hive line. Arguments are either --flag or --flag=value
+    def parseCellArgs(self, line):
+        args = {}
+        for tok in line.replace("\r", "").split():
+            if tok.find("--") == 0:
+                k, sep, v = tok[2:].partition("=")
+                if sep == "":
+                    v = True
+                args[k.lower()] = v
+            else:
+                print("WARNING - Ignoring %%%%%s argument %s - arguments are of the form --flag or --flag=value" % (self.name_str, tok))
+        return args
+
 
 # Display Help must be completely customized, please look at this Hive example
     def displayCustomHelp(self):
@@ -250,6 +1427,27 @@ class Integration(Magics):
         print("{: <30} {: <80}".format(*["%hive disconnect", "Disconnect an active Hive connection and reset connection variables"]))
         print("{: <30} {: <80}".format(*["%hive set %variable% %value%", "Set the variable %variable% to the value %value%"]))
         print("{: <30} {: <80}".format(*["%hive debug", "Sets an internal debug variable to True (False by default) to see more verbose info about connections"]))
+        print("{: <30} {: <80}".format(*["%hive profile", "Toggle printing a per phase timing breakdown (validate, execute, fetch, render...) after each query"]))
+        print("{: <30} {: <80}".format(*["%hive history", "Return the recent query history with timings, rows/sec, bytes and memory as a DataFrame"]))
+        print("{: <30} {: <80}".format(*["%hive history clear", "Clear the query history"]))
+        print("{: <30} {: <80}".format(*["%hive rules", "List the query validation rules, disable them with %hive set hive_rules_disabled name1,name2"]))
+        print("{: <30} {: <80}".format(*["%hive jobs", "List async queries and their status"]))
+        print("{: <30} {: <80}".format(*["%hive cancel %id%", "Cancel the async query with id %id%"]))
+        print("{: <30} {: <80}".format(*["%hive cache status", "Show the result cache location, size and hit rate (enable with %hive set hive_cache True)"]))
+        print("{: <30} {: <80}".format(*["%hive cache clear", "Remove every cached result"]))
+        print("{: <30} {: <80}".format(*["%hive cache bypass", "Skip the cache for the next query and refresh its cached result"]))
+        print("{: <30} {: <80}".format(*["%hive load %path% %var%", "Open a file saved with --to as %var% (default prev_hive). arrow: is memory mapped as an Arrow Table"]))
+        print("{: <30} {: <80}".format(*["", "parquet: is opened as a pyarrow ParquetFile, read the columns or row groups you need from it"]))
+        print("{: <30} {: <80}".format(*["%hive broker", "Show the shared broker's counters (queries run, shared with other kernels, served from its results)"]))
+        print("{: <30} {: <80}".format(*["%hive promote", "Run the full version of the last --preview query in the background, results go to prev_hive"]))
+        print("{: <30} {: <80}".format(*["%hive incremental", "List the stored incremental query results with their watermarks"]))
+        print("{: <30} {: <80}".format(*["%hive incremental clear %id%", "Remove the stored incremental result %id% (all of them without %id%), the next run fetches everything"]))
+        print("{: <30} {: <80}".format(*["%hive databases", "List databases from the metadata cache (fetched from the server only if missing or older than hive_meta_ttl)"]))
+        print("{: <30} {: <80}".format(*["%hive tables %db%", "List the tables in %db% (default hive_meta_default_db) from the metadata cache"]))
+        print("{: <30} {: <80}".format(*["%hive describe %table%", "List the columns of %table% (db.table or table) from the metadata cache"]))
+        print("{: <30} {: <80}".format(*["%hive partitions %table%", "List the partitions of %table% from the metadata cache"]))
+        print("{: <30} {: <80}".format(*["%hive refresh %name%", "Reload the metadata of a database (tables and columns) or a db.table in the background"]))
+        print("{: <30} {: <80}".format(*["", "With no %name%, reloads the database list and hive_meta_default_db. Tab completion in %%hive cells uses this cache"]))
         print("")
         print("Running queries with %%hive")
         print("###############################################################################################")
@@ -264,6 +1462,31 @@ class Integration(Magics):
         print("- You can change pd_display.max_rows with %hive set pd_display.max_rows 2000")
         print("- The results, regardless of display will be place in a Pandas Dataframe variable called prev_hive")
         print("- prev_hive is overwritten every time a successful query is run. If you want to save results assign it to a new variable")
+        print("- With %hive set pd_display_paged True, results of any size are shown a page (pd_page_size rows) at a time, keeping the notebook small")
+        print("- With hive_broker_socket set (JUPYTERHUB_HIVE_BROKER_SOCKET), queries go through a broker shared by the kernels on this host")
+        print("  Identical queries run once and results up to hive_broker_max_age seconds old are reused, for kernels of the same Unix user")
+        print("")
+        print("Arguments can be added after %%hive on the first line of the cell, for example %%hive --stream")
+        print("###############################################################################################")
+        print("")
+        print("{: <30} {: <80}".format(*["--stream", "Fetch the results in batches of hive_fetch_batch_size rows. Only hive_max_rows rows are kept in prev_hive"]))
+        print("{: <30} {: <80}".format(*["", "If hive_stream_spill_path is set, the full result is also written to that CSV file"]))
+        print("{: <30} {: <80}".format(*["--async", "Run the query in the background. The kernel is free while it runs and the result is placed in prev_hive"]))
+        print("{: <30} {: <80}".format(*["--batch", "Split the cell into ; separated statements and run them in parallel (up to hive_batch_workers at once)"]))
+        print("{: <30} {: <80}".format(*["--each=var", "Run the cell once for every value in the notebook variable var, with {var} in the query replaced by the value"]))
+        print("{: <30} {: <80}".format(*["--serial", "With --batch/--each, run the queries in order on one connection (for scripts using SET, USE, etc)"]))
+        print("{: <30} {: <80}".format(*["--combine=concat|dict", "With --batch/--each, concat results into one DataFrame, or keep a dict of DataFrames (default hive_batch_combine)"]))
+        print("{: <30} {: <80}".format(*["--workers=N", "With --batch/--each, run at most N queries at once"]))
+        print("{: <30} {: <80}".format(*["--timeout=N", "Cancel the query on the server if it runs longer than N seconds (default hive_query_timeout)"]))
+        print("{: <30} {: <80}".format(*["--preview", "Quick look: return at most min(pd_display.max_rows, hive_max_rows) rows, sampling with hive_preview_sample if set"]))
+        print("{: <30} {: <80}".format(*["--preview=N", "Same, returning at most N rows. Results are marked as a preview (prev_hive.attrs['preview'])"]))
+        print("{: <30} {: <80}".format(*["--incremental", "Keep the result locally and only fetch rows with hive_partition_col >= the largest value already stored (the column must be selected)"]))
+        print("{: <30} {: <80}".format(*["--incremental=col", "Same, using col as the watermark column (e.g. --incremental=t.day for a join)"]))
+        print("{: <30} {: <80}".format(*["--full", "With --incremental, fetch everything again and replace the stored result"]))
+        print("{: <30} {: <80}".format(*["--worker", "Fetch in a separate process limited to hive_worker_memory_mb, so a huge result can't take the kernel down"]))
+        print("{: <30} {: <80}".format(*["", "prev_hive keeps hive_max_rows rows, the full result is memory mapped in prev_hive_arrow (an Arrow Table)"]))
+        print("{: <30} {: <80}".format(*["--nocache", "Don't use or update the result cache for this query"]))
+        print("{: <30} {: <80}".format(*["--to=format:path", "Write the full result to path as it is fetched, format is csv, parquet or arrow. Only hive_max_rows rows are kept in prev_hive"]))
 
     # This is the function that is actually called. 
     def displayHelp(self):
@@ -282,6 +1505,13 @@ class Integration(Magics):
             elif line.lower() == "debug":
                 print("Toggling Debug from %s to %s" % (self.debug, not self.debug))
                 self.debug = not self.debug
+            elif line.lower() == "profile":
+                print("Toggling Profile from %s to %s" % (self.profile, not self.profile))
+                self.profile = not self.profile
+            elif line.lower() == "history":
+                return self.history.toDataFrame()
+            elif line.lower() == "history clear":
+                self.history.clear()
             elif line.lower() == "disconnect":
                 self.disconnect()
             elif line.lower() == "connect alt":
@@ -290,40 +1520,123 @@ class Integration(Magics):
                 self.connect(False)
             elif line.lower().find('set ') == 0:
                 self.setvar(line)
+            elif line.lower() == "jobs":
+                self.listQueries()
+            elif line.lower().find('cancel ') == 0:
+                self.cancelQuery(line[7:].strip())
+            elif line.lower().find('cache') == 0:
+                self.cacheCommand(line[5:])
+            elif line.lower() == "broker":
+                self.brokerCommand()
+            elif line.lower() == "promote":
+                self.promotePreview()
+            elif line.lower().find('incremental') == 0:
+                return self.incrementalCommand(line[11:])
+            elif line.lower().find('load ') == 0:
+                self.loadCommand(line[5:])
+            elif line.lower() == "rules":
+                self.listRules()
+            elif line.lower().split(" ")[0] in ['databases', 'tables', 'describe', 'partitions', 'refresh']:
+                cmd = line.split(" ")[0]
+                return self.metaCommand(cmd.lower(), line[len(cmd):])
             else:
                 print("I am sorry, I don't know what you want to do, try just %" + self.name_str + "for help options")
         else: # This is run is the cell is not none, thus it's a cell to process  - For us, that means a query
             cell = cell.replace("\r", "")
-            if self.connected == True:
-                result_df, qtime, status = self.runQuery(cell)
+            cell_args = self.parseCellArgs(line)
+            use_cache = None
+            if cell_args.get('nocache', False) == True:
+                use_cache = False
+            stream = cell_args.get('stream', None)
+            spill_path = None
+            if cell_args.get('to', True) != True:
+                # Exporting streams the result straight to the file, prev_<name> only keeps the first _max_rows rows
+                spill_path = cell_args['to']
+                stream = True
+                use_cache = False
+            timeout = cell_args.get('timeout', None)
+            worker = self.opts[self.name_str + '_worker'][0]
+            if cell_args.get('worker', False) == True:
+                worker = True
+            if self.connected == True and (cell_args.get('batch', False) == True or cell_args.get('each', False) != False):
+                keys, queries = self.expandBatch(cell, cell_args)
+                if keys is not None:
+                    # Reruns are tracked on the whole cell, so confirm warnings are given once per batch
+                    rerun = self.last_query == line + "\n" + cell
+                    self.last_query = line + "\n" + cell
+                    result, statuses = self.runBatch(keys, queries, stream=stream, workers=cell_args.get('workers', None), combine=cell_args.get('combine', None),
+                                                     serial=cell_args.get('serial', False), timeout=timeout, rerun=rerun)
+                    if result is not None:
+                        self.ipy.user_ns['prev_' + self.name_str] = result
+                        if isinstance(result, dict):
+                            print("Results placed in prev_%s as a dict of DataFrames keyed on %s" % (self.name_str, ", ".join(str(k) for k in result.keys())))
+                        else:
+                            print("Combined results placed in prev_%s" % self.name_str)
+                            print("")
+                            self.displayResults(result)
+            elif self.connected == True and cell_args.get('incremental', False) == False and cell_args.get('preview', False) == False and (cell_args.get('async', False) == True or self.opts[self.name_str + '_async'][0] == True):
+                job_id = self.runQueryAsync(cell, stream=stream, use_cache=use_cache, spill_path=spill_path, timeout=timeout, worker=worker)
+                if job_id is not None:
+                    print("Submitted async query %s - results will be placed in prev_%s. Cancel with %%%s cancel %s" % (job_id, self.name_str, self.name_str, job_id))
+            elif self.connected == True:
+                profile = QueryProfile(cell)
+                if cell_args.get('incremental', False) != False:
+                    column = None
+                    if cell_args['incremental'] != True:
+                        column = cell_args['incremental']
+                    result_df, qtime, status = self.runIncremental(cell, column=column, full=cell_args.get('full', False) == True, profile=profile, timeout=timeout)
+                elif cell_args.get('preview', False) != False:
+                    profile.mode = "preview"
+                    result_df, qtime, status = self.runPreview(cell, rows=cell_args['preview'], use_cache=use_cache, profile=profile, timeout=timeout)
+                else:
+                    result_df, qtime, status = self.runQuery(cell, stream=stream, use_cache=use_cache, spill_path=spill_path, profile=profile, timeout=timeout, worker=worker)
                 if status.find("Failure") == 0:
                     print("Error: %s" % status)
                 elif status.find("Success - No Results") == 0:
                     print("No Results returned in %s seconds" % qtime)
+                elif status.find("ValidationError") == 0:
+                    pass
                 else:
-                   self.myip.user_ns['prev_' + self.name_str] = result_df
+                   self.ipy.user_ns['prev_' + self.name_str] = result_df
                    mycnt = len(result_df)
-                   print("%s Records in Approx %s seconds" % (mycnt,qtime))
+                   if status == "Success - Preview":
+                       print("PREVIEW - %s Records in Approx %s seconds, %s. This is not the full result" % (mycnt, qtime, result_df.attrs['preview']))
+                       print("Run %%%s promote to run the full query in the background" % self.name_str)
+                   elif status == "Success - Cached":
+                       print("%s Records from the result cache" % mycnt)
+                   elif self.last_row_count > mycnt and 'full_result' in result_df.attrs:
+                       print("%s Records in Approx %s seconds - First %s kept in prev_%s, all of them memory mapped in %s" % (self.last_row_count, qtime, mycnt, self.name_str, result_df.attrs['full_result']))
+                   elif self.last_row_count > mycnt:
+                       print("%s Records in Approx %s seconds - First %s kept in prev_%s" % (self.last_row_count, qtime, mycnt, self.name_str))
+                   else:
+                       print("%s Records in Approx %s seconds" % (mycnt,qtime))
                    print("")
 
-                   if mycnt <= int(self.opts['pd_display.max_rows'][0]):
-                       if self.debug:
-                           print("Testing max_colwidth: %s" %  pd.get_option('max_colwidth'))
-                       if self.opts['pd_use_beaker'][0] == True:
-                           if self.opts['pd_beaker_bool_workaround'][0]== True:
-                                for x in result_df.columns:
-                                    if result_df.dtypes[x] == 'bool':
-                                        result_df[x] = result_df[x].astype(object)
-                           display(TableDisplay(result_df))
-                       else:
-                           display(HTML(result_df.to_html(index=self.opts['pd_display_idx'][0])))
-                   else:
-                       print("Number of results (%s) greater than pd_display_max(%s)" % (mycnt, self.opts['pd_display.max_rows'][0]))
+                   with profile.phase('render'):
+                       self.displayResults(result_df)
+                self.finishProfile(profile, status, self.last_row_count, result_df)
 
 
             else:
-                print(self.name_str.capitalize() + " is not connected: Please see help at %" + self.name_str + ")
+                print(self.name_str.capitalize() + " is not connected: Please see help at %" + self.name_str)
+
 
+    def displayResults(self, result_df):
+        self.applyPandasOptions()
+        mycnt = len(result_df)
+        if self.opts['pd_display_paged'][0] == True and self.opts['pd_use_beaker'][0] != True:
+            # Only the current page is ever rendered, so there is no need to hold back large results
+            display(PagedTable(result_df, page_size=self.opts['pd_page_size'][0], index=self.opts['pd_display_idx'][0], transform=self.prepareDisplay).widget)
+        elif mycnt <= int(self.opts['pd_display.max_rows'][0]):
+            if self.debug:
+                print("Testing max_colwidth: %s" %  pd.get_option('max_colwidth'))
+            if self.opts['pd_use_beaker'][0] == True:
+                from beakerx import TableDisplay
+                display(TableDisplay(self.prepareDisplay(result_df)))
+            else:
+                display(HTML(self.prepareDisplay(result_df).to_html(index=self.opts['pd_display_idx'][0])))
+        else:
+            print("Number of results (%s) greater than pd_display_max(%s)" % (mycnt, self.opts['pd_display.max_rows'][0]))
 
     def retStatus(self):
 
@@ -331,6 +1644,16 @@ class Integration(Magics):
         print("")
         print("{: <30} {: <50}".format(*["Connected:", str(self.connected)]))
         print("{: <30} {: <50}".format(*["Debug Mode:", str(self.debug)]))
+        if self.pool is not None:
+            pool_status = self.pool.status()
+            print("{: <30} {: <50}".format(*["Pool Connections:", "%(idle)s idle, %(in_use)s in use (max %(max_size)s), %(created)s opened, %(reconnects)s reconnected" % pool_status]))
+        if self.getBroker() is not None:
+            print("{: <30} {: <50}".format(*["Broker Socket:", self.broker.path]))
+        if self.metadata is not None:
+            meta_status = self.metadata.status()
+            print("{: <30} {: <50}".format(*["Metadata Cache:", "%(databases)s databases, %(tables)s tables, %(described_tables)s described, %(refreshing)s refreshing" % meta_status]))
+            if meta_status['last_error'] != "":
+                print("{: <30} {: <50}".format(*["Last Metadata Error:", meta_status['last_error']]))
 
         print("")
 
@@ -367,18 +1690,34 @@ class Integration(Magics):
 
     def setvar(self, line):
         pd_set_vars = ['pd_display.max_columns', 'pd_display.max_rows', 'pd_max_colwidth', 'pd_use_beaker']
-        allowed_opts = pd_set_vars + ['pd_replace_crlf', 'pd_display_idx', self.name_str + '_base_url']
+        allowed_opts = pd_set_vars + ['pd_replace_crlf', 'pd_display_idx', 'pd_display_paged', 'pd_page_size', 'pd_shrink_dtypes', 'pd_category_max_ratio', 'pd_beaker_bool_workaround']
+        allowed_opts += [self.name_str + '_base_url', self.name_str + '_verbose_errors']
+        allowed_opts += [self.name_str + '_partition_col', self.name_str + '_auto_limit', self.name_str + '_rules_disabled']
+        allowed_opts += [self.name_str + '_stream_fetch', self.name_str + '_fetch_batch_size', self.name_str + '_stream_spill_path']
+        allowed_opts += [self.name_str + '_batch_workers', self.name_str + '_batch_combine']
+        allowed_opts += [self.name_str + '_async', self.name_str + '_async_workers', self.name_str + '_query_timeout', self.name_str + '_poll_interval']
+        allowed_opts += [self.name_str + '_history_size', self.name_str + '_history_log']
+        allowed_opts += [self.name_str + '_meta_ttl', self.name_str + '_meta_default_db', self.name_str + '_meta_preload', self.name_str + '_meta_workers']
+        allowed_opts += [self.name_str + '_meta_columns_query', self.name_str + '_meta_complete']
+        allowed_opts += [self.name_str + '_incremental_dir', self.name_str + '_preview_sample']
+        allowed_opts += [self.name_str + '_worker', self.name_str + '_worker_memory_mb', self.name_str + '_worker_dir']
+        allowed_opts += [self.name_str + '_broker_socket', self.name_str + '_broker_max_age']
+        allowed_opts += [self.name_str + '_cache', self.name_str + '_cache_dir', self.name_str + '_cache_ttl', self.name_str + '_cache_max_bytes']
+        allowed_opts += [self.name_str + '_pool_min_size', self.name_str + '_pool_max_size', self.name_str + '_pool_idle_timeout', self.name_str + '_pool_ping_interval', self.name_str + '_pool_ping_query']
 
         tline = line.replace('set ', '')
-        tkey = tline.split(' ')[0]
-        tval = tline.split(' ')[1]
+        tkey = tline.split(' ', 1)[0]
+        tval = tline.split(' ', 1)[1]
         if tval == "False":
             tval = False
         if tval == "True":
             tval = True
         if tkey in allowed_opts:
             self.opts[tkey][0] = tval
-            if tkey in pd_set_vars:
+            if tkey == 'pd_use_beaker':
+                if tval == True:
+                    self.loadBeaker()
+            elif tkey in pd_set_vars:
                 try:
                     t = int(tval)
                 except:
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+# Deferred module imports. lazyModule('pandas') returns a stand in that imports pandas the first time an attribute
+# is used, so importing integration_core (and starting a kernel that never runs a query) doesn't pay for heavy imports
+import importlib
+import importlib.util
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    # Import the module now (raises ImportError if it isn't installed)
+    def _load(self):
+        if self._lazy_module is None:
+            self.__dict__['_lazy_module'] = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        if self._lazy_module is None:
+            return "<lazy module '%s' (not loaded)>" % self._lazy_name
+        return repr(self._lazy_module)
+
+
+def lazyModule(name):
+    return LazyModule(name)
+
+
+# True if module name can be imported, without importing it
+def isAvailable(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
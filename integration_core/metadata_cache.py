@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+# Local cache of the server catalog: databases, the tables in each database, the columns of each table and
+# the partitions of each table. Every entry is fetched once, kept for ttl seconds, and saved to a JSON file so
+# it survives kernel restarts. Whole databases are loaded in the background (the tables, then the columns of every
+# table in parallel, or all at once with a bulk loader) so commands and tab completion can be answered locally.
+#
+# The cache doesn't know how to talk to the server, it is given loaders (callables) for each kind of entry:
+#   databases()              -> list of database names
+#   tables(db)               -> list of table names in db
+#   columns(db.table)        -> list of [column, type, comment, is_partition_column]
+#   partitions(db.table)     -> list of partition names (e.g. day=2020-01-01)
+#   bulk_columns(db)         -> optional, dict of table -> columns for the whole database, or None if not available
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from integration_core.query_rules import tokenize
+
+kinds = ['databases', 'tables', 'columns', 'partitions']
+
+
+class MetadataCache(object):
+    def __init__(self, loaders, path=None, ttl=3600, workers=4):
+        self.loaders = loaders
+        self.path = path
+        self.ttl = int(ttl)
+        self.workers = max(int(workers), 1)
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.failed = {} # key -> time of background refreshes that failed, not retried for retry_after seconds
+        self.retry_after = 60
+        self.last_error = ""
+        self.fetches = 0
+        self.local = threading.local() # Whether the fetch running on this thread replaces a cached entry, see reloading
+        self.entries = self.loadEntries()
+
+    def loadEntries(self):
+        entries = {}
+        for kind in kinds:
+            entries[kind] = {}
+        if self.path is None:
+            return entries
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for kind in kinds:
+                entries[kind].update(saved.get(kind, {}))
+        except (IOError, OSError, ValueError):
+            pass
+        return entries
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        try:
+            tmp = self.path + ".%s.tmp" % os.getpid()
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            print("WARNING - Could not save metadata cache to %s: %s" % (self.path, e))
+
+    def fresh(self, entry):
+        return entry is not None and (self.ttl <= 0 or time.time() - entry['fetched'] <= self.ttl)
+
+    def store(self, kind, name, value):
+        with self.lock:
+            self.entries[kind][name] = {'value': value, 'fetched': time.time()}
+
+    # Fetch one entry from the server and store it (name is "" for databases)
+    # reload is True when a cached copy is being replaced (a refresh, or an expired entry), None works it out from whether
+    # the entry is cached. Loaders can check reloading() to skip any cache of their own
+    def fetch(self, kind, name, save=True, reload=None):
+        if reload is None:
+            with self.lock:
+                reload = name in self.entries[kind]
+        with self.reloads(reload):
+            if kind == 'databases':
+                value = self.loaders[kind]()
+            else:
+                value = self.loaders[kind](name)
+        self.fetches += 1
+        self.store(kind, name, value)
+        if save == True:
+            self.save()
+        return value
+
+    @contextmanager
+    def reloads(self, reload):
+        prev = getattr(self.local, 'reload', False)
+        self.local.reload = reload
+        try:
+            yield
+        finally:
+            self.local.reload = prev
+
+    # True while a loader called on this thread is replacing a cached entry
+    def reloading(self):
+        return getattr(self.local, 'reload', False)
+
+    # Returns the entry, fetching it from the server first if it isn't cached or has expired
+    def get(self, kind, name=""):
+        with self.lock:
+            entry = self.entries[kind].get(name, None)
+        if self.fresh(entry):
+            return entry['value']
+        return self.fetch(kind, name)
+
+    # Returns the cached entry (even an expired one) or None, never waiting on the server
+    # A missing or expired entry is refreshed in the background, so it is there the next time
+    def peek(self, kind, name=""):
+        with self.lock:
+            entry = self.entries[kind].get(name, None)
+        if not self.fresh(entry):
+            self.refreshEntry(kind, name)
+        if entry is None:
+            return None
+        return entry['value']
+
+    def refreshEntry(self, kind, name):
+        self.background((kind, name), self.fetch, kind, name)
+
+    # Run func on a background thread, unless a refresh with the same key is already running
+    # Errors can't be printed from the background (they would land in whatever cell is running), they are kept in last_error
+    def background(self, key, func, *args, **kwargs):
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            if kwargs.get('retry', False) == False and time.time() - self.failed.get(key, 0) < self.retry_after:
+                return False
+            self.refreshing.add(key)
+            self.failed.pop(key, None)
+
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                with self.lock:
+                    self.failed[key] = time.time()
+                    self.last_error = "%s: %s" % (" ".join(str(k) for k in key if k != ""), e)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return True
+
+    # Load the tables of db and the columns of every table, replacing what is cached
+    # Columns come from bulk_columns if there is a loader for it, otherwise one columns call per table, run in parallel
+    def loadDatabase(self, db):
+        tables = self.fetch('tables', db, save=False, reload=True)
+        bulk = None
+        if self.loaders.get('bulk_columns', None) is not None:
+            with self.reloads(True):
+                bulk = self.loaders['bulk_columns'](db)
+        if bulk is not None:
+            self.fetches += 1
+            for table in tables:
+                self.store('columns', db + "." + table, bulk.get(table, []))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.fetch, 'columns', db + "." + table, False, True) for table in tables]
+                for f in futures:
+                    try:
+                        f.result()
+                    except Exception:
+                        pass
+        self.save()
+
+    # Refresh name (a database, or a db.table) or, with no name, the database list
+    # Returns False if a refresh of the same thing was already running
+    def refresh(self, name="", background=True):
+        if name == "":
+            job = (self.fetch, 'databases', "", True, True)
+        elif name.find(".") >= 0:
+            job = (self.refreshTable, name)
+        else:
+            job = (self.loadDatabase, name)
+        if background == True:
+            return self.background(('refresh', name), *job, retry=True)
+        job[0](*job[1:])
+        return True
+
+    def refreshTable(self, name):
+        self.fetch('columns', name, save=False, reload=True)
+        with self.lock:
+            had_partitions = name in self.entries['partitions']
+        if had_partitions:
+            self.fetch('partitions', name, save=False, reload=True)
+        self.save()
+
+    # Drop name (a database, a db.table, or everything with no name) so it is fetched again on next use
+    def invalidate(self, name=""):
+        with self.lock:
+            if name == "":
+                for kind in kinds:
+                    self.entries[kind].clear()
+            else:
+                for kind in kinds:
+                    for k in list(self.entries[kind].keys()):
+                        if k == name or k.find(name + ".") == 0:
+                            del self.entries[kind][k]
+        self.save()
+
+    # Completions for token from the cache only, never waiting on the server
+    # db.tab completes tables in db, table.col (or alias.col) completes columns, anything else completes databases,
+    # tables in default_db, and columns of the tables used in query
+    def complete(self, token, query="", default_db="default"):
+        token_lower = token.lower()
+        matches = []
+        dbs = self.peek('databases') or []
+        refs = tableRefs(query, default_db)
+        if token.find(".") >= 0:
+            prefix, sep, partial = token.rpartition(".")
+            if prefix.lower() in [d.lower() for d in dbs] and prefix.find(".") < 0:
+                matches += [prefix + "." + t for t in (self.peek('tables', prefix.lower()) or []) if t.lower().find(partial.lower()) == 0]
+            table = refs.get(prefix.lower(), qualify(prefix.lower(), default_db))
+            if self.knownTable(table):
+                for col in self.peek('columns', table) or []:
+                    if col[0].lower().find(partial.lower()) == 0:
+                        matches.append(prefix + "." + col[0])
+        else:
+            matches += [d for d in dbs if d.lower().find(token_lower) == 0]
+            matches += [t for t in (self.peek('tables', default_db) or []) if t.lower().find(token_lower) == 0]
+            for table in sorted(set(refs.values())):
+                if not self.knownTable(table):
+                    continue
+                for col in self.peek('columns', table) or []:
+                    if col[0].lower().find(token_lower) == 0:
+                        matches.append(col[0])
+        return list(OrderedDict.fromkeys(matches))
+
+    # True if table (db.table) is in the cached table list of its database
+    def knownTable(self, table):
+        db, sep, name = table.partition(".")
+        return name in (self.peek('tables', db) or [])
+
+    def status(self):
+        with self.lock:
+            return OrderedDict([('path', self.path), ('ttl', self.ttl), ('databases', len(self.entries['databases'].get("", {}).get('value', []))),
+                                ('tables', sum(len(v['value']) for v in self.entries['tables'].values())),
+                                ('described_tables', len(self.entries['columns'])), ('partitioned_tables', len(self.entries['partitions'])),
+                                ('refreshing', len(self.refreshing)), ('server_fetches', self.fetches), ('last_error', self.last_error)])
+
+
+def qualify(table, default_db="default"):
+    if table.find(".") >= 0:
+        return table
+    return default_db + "." + table
+
+
+# Tables used in query (after FROM or JOIN), as a dict of alias (and table name) -> db.table
+def tableRefs(query, default_db="default"):
+    refs = {}
+    if query is None or query == "":
+        return refs
+    toks = tokenize(query)
+    i = 0
+    while i < len(toks):
+        if toks[i].kind == 'ident' and toks[i].lower in ['from', 'join'] and i + 1 < len(toks) and toks[i + 1].kind == 'ident':
+            name = toks[i + 1].lower
+            i += 2
+            while i + 1 < len(toks) and toks[i].text == '.' and toks[i + 1].kind == 'ident':
+                name += "." + toks[i + 1].lower
+                i += 2
+            table = qualify(name, default_db)
+            refs[name] = table
+            refs[name.split(".")[-1]] = table
+            if i < len(toks) and toks[i].lower == 'as':
+                i += 1
+            if i < len(toks) and toks[i].kind == 'ident' and toks[i].lower not in reserved_words:
+                refs[toks[i].lower] = table
+        else:
+            i += 1
+    return refs
+
+
+# Words that can follow a table name but are not an alias
+reserved_words = ['where', 'join', 'left', 'right', 'full', 'inner', 'outer', 'cross', 'on', 'group', 'order', 'limit',
+                  'union', 'lateral', 'having', 'sort', 'cluster', 'distribute', 'tablesample', 'select', 'using', 'window']
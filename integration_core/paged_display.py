@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Paged table display backed by ipywidgets. Only the HTML for the rows on the current page is built, and
+# other pages are rendered in the kernel when the user asks for them, so the notebook only ever stores a
+# widget reference instead of a multi-megabyte HTML table
+from integration_core.lazy_import import lazyModule
+widgets = lazyModule('ipywidgets')
+
+
+class PagedTable(object):
+    # transform, if given, is applied to the rows of each page before they are rendered
+    def __init__(self, df, page_size=25, index=False, transform=None):
+        self.df = df
+        self.transform = transform
+        self.page_size = max(int(page_size), 1)
+        self.index = index
+        self.page = 0
+        self.pages = max((len(df) + self.page_size - 1) // self.page_size, 1)
+
+        self.table = widgets.HTML()
+        self.label = widgets.Label()
+        self.first_button = widgets.Button(description="<<", layout=widgets.Layout(width="45px"))
+        self.prev_button = widgets.Button(description="<", layout=widgets.Layout(width="45px"))
+        self.next_button = widgets.Button(description=">", layout=widgets.Layout(width="45px"))
+        self.last_button = widgets.Button(description=">>", layout=widgets.Layout(width="45px"))
+        self.first_button.on_click(lambda b: self.showPage(0))
+        self.prev_button.on_click(lambda b: self.showPage(self.page - 1))
+        self.next_button.on_click(lambda b: self.showPage(self.page + 1))
+        self.last_button.on_click(lambda b: self.showPage(self.pages - 1))
+        controls = widgets.HBox([self.first_button, self.prev_button, self.next_button, self.last_button, self.label])
+        self.widget = widgets.VBox([controls, self.table])
+        self.showPage(0)
+
+    def showPage(self, page):
+        self.page = min(max(page, 0), self.pages - 1)
+        start = self.page * self.page_size
+        end = min(start + self.page_size, len(self.df))
+        page_df = self.df.iloc[start:end]
+        if self.transform is not None:
+            page_df = self.transform(page_df)
+        self.table.value = page_df.to_html(index=self.index)
+        self.label.value = "Rows %s-%s of %s (page %s of %s)" % (min(start + 1, end), end, len(self.df), self.page + 1, self.pages)
+        self.first_button.disabled = self.page == 0
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= self.pages - 1
+        self.last_button.disabled = self.page >= self.pages - 1
+
+    def _ipython_display_(self):
+        from IPython.display import display
+        display(self.widget)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+# Query rewrites for %%hive --preview, a quick first look at a query's results. The top level LIMIT is pushed down to
+# the preview size (so simple selects can be answered by a fetch task instead of a full scan), and the first table can
+# be sampled with TABLESAMPLE so filters and aggregates only read part of it
+from integration_core.query_rules import ParsedQuery
+
+
+# Lower the top level LIMIT of query to rows (or add one). LIMIT offset, count (Hive 2+) keeps the offset
+# Returns the new query and the LIMIT the query had before (None if it had none)
+def pushLimit(query, rows):
+    parsed = ParsedQuery(query)
+    toks = parsed.tokens
+    count = parsed.limitToken()
+    if count < 0:
+        trimmed = parsed.trimmed()
+        return "%s\nLIMIT %s" % (trimmed, rows), None
+    old = int(float(toks[count].text))
+    if old <= rows:
+        return query, old
+    return query[:toks[count].start] + str(rows) + query[toks[count].end:], old
+
+
+# Add TABLESAMPLE(sample) after the first table in the top level FROM (e.g. sample "1 PERCENT" or "BUCKET 1 OUT OF 100 ON rand()")
+# Returns the query unchanged and False if the first thing in the FROM isn't a table (a subquery, for example)
+def addTableSample(query, sample):
+    parsed = ParsedQuery(query)
+    toks = parsed.tokens
+    i = parsed.find('from', top_level=True)
+    if i < 0 or i + 1 >= len(toks) or toks[i + 1].kind != 'ident':
+        return query, False
+    end = i + 1
+    while end + 2 < len(toks) and toks[end + 1].text == '.' and toks[end + 2].kind == 'ident':
+        end += 2
+    if end + 1 < len(toks) and toks[end + 1].lower == 'tablesample':
+        return query, False
+    pos = toks[end].end
+    return query[:pos] + " TABLESAMPLE(%s)" % sample + query[pos:], True
+
+
+# Returns the preview query and a description of what was done to it
+def previewQuery(query, rows, sample=""):
+    notes = []
+    if sample is not None and sample != "":
+        query, sampled = addTableSample(query, sample)
+        if sampled:
+            notes.append("sampled with TABLESAMPLE(%s)" % sample)
+        else:
+            notes.append("not sampled (the first FROM item is not a table)")
+    query, old = pushLimit(query, rows)
+    if old is None or old > rows:
+        notes.append("limited to %s rows" % rows)
+    return query, ", ".join(notes)
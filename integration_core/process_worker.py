@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+# Runs a query in a separate worker process. The worker opens its own connection, fetches in batches, builds the
+# DataFrames and writes them to a file (Arrow IPC in shared memory by default), so the kernel never holds the full
+# result and never pays for building it. The kernel memory maps the finished file, which is zero copy.
+#
+# The worker runs with its own address space limit, so a result that is too big fails (or kills) the worker only,
+# and the kernel, with everything else the user has loaded, keeps running.
+#
+# Workers are started with the spawn method, so the connection opener has to be picklable, a module level function
+# or a classmethod of an importable class (see Integration.openConnection)
+import os
+import time
+import signal
+import tempfile
+import multiprocessing
+
+from integration_core.result_export import openResultWriter
+from integration_core.execution import pollExecute, QueryCancelled
+
+
+class WorkerCancelled(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+def onTerminate(signum, frame):
+    raise WorkerCancelled("Cancelled")
+
+
+# Where temporary worker results go: /dev/shm (memory backed, so attaching doesn't touch disk) if it's there, else the temp dir
+def workerDir(path=""):
+    if path is not None and path != "":
+        return os.path.expanduser(path)
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+# The worker process. Messages sent back on pipe:
+#   ('rows', count)                      after every batch
+#   ('done', rows, columns, phases)      columns is None if the query had no result set
+#   ('cancelled', message) / ('error', message)
+def workerMain(open_connection, conn_args, query, fmt, path, batch_size, memory_mb, poll_interval, pipe):
+    signal.signal(signal.SIGTERM, onTerminate)
+    if memory_mb > 0:
+        import resource
+        limit = int(memory_mb) * 1048576
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    import pandas as pd
+    phases = {}
+    conn = None
+    cursor = None
+    writer = None
+    try:
+        t = time.perf_counter()
+        conn = open_connection(**conn_args)
+        phases['acquire'] = time.perf_counter() - t
+        cursor = conn.cursor()
+        t = time.perf_counter()
+        pollExecute(cursor, query, poll_interval)
+        phases['execute'] = time.perf_counter() - t
+        if cursor.description is None:
+            pipe.send(('done', 0, None, phases))
+            return
+        columns = [col[0] for col in cursor.description]
+        rows = 0
+        fetch_phase = 'first_row'
+        while True:
+            t = time.perf_counter()
+            batch_rows = cursor.fetchmany(batch_size)
+            phases[fetch_phase] = phases.get(fetch_phase, 0.0) + time.perf_counter() - t
+            fetch_phase = 'fetch'
+            if not batch_rows:
+                break
+            t = time.perf_counter()
+            batch = pd.DataFrame.from_records(batch_rows, columns=columns, coerce_float=True)
+            phases['frame'] = phases.get('frame', 0.0) + time.perf_counter() - t
+            t = time.perf_counter()
+            if writer is None:
+                writer = openResultWriter(fmt, path)
+            writer.write(batch)
+            phases['spill'] = phases.get('spill', 0.0) + time.perf_counter() - t
+            rows += len(batch)
+            batch = None
+            batch_rows = None
+            pipe.send(('rows', rows))
+        if writer is not None:
+            writer.close()
+            writer = None
+        pipe.send(('done', rows, columns, phases))
+    except (WorkerCancelled, QueryCancelled) as e:
+        if cursor is not None and hasattr(cursor, 'cancel'):
+            try:
+                cursor.cancel()
+            except Exception:
+                pass
+        pipe.send(('cancelled', str(e)))
+    except MemoryError:
+        pipe.send(('error', "The worker ran out of memory (limit %s MB) - raise it with the worker_memory_mb opt or fetch less" % memory_mb))
+    except Exception as e:
+        pipe.send(('error', str(e)))
+    finally:
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for obj in [cursor, conn]:
+            if obj is not None:
+                try:
+                    obj.close()
+                except Exception:
+                    pass
+
+
+class ProcessWorker(object):
+    def __init__(self, open_connection, conn_args, query, fmt, path, batch_size=10000, memory_mb=0, poll_interval=0.5):
+        self.args = (open_connection, conn_args, query, fmt, path, int(batch_size), int(memory_mb), float(poll_interval))
+        self.memory_mb = int(memory_mb)
+        self.poll_interval = float(poll_interval)
+        self.proc = None
+        self.pipe = None
+        self.rows = 0
+
+    def start(self):
+        ctx = multiprocessing.get_context('spawn')
+        self.pipe, child = ctx.Pipe(duplex=False)
+        self.proc = ctx.Process(target=workerMain, args=self.args + (child,))
+        self.proc.daemon = True
+        self.proc.start()
+        child.close()
+
+    # Wait for the worker to finish and return its final message. check is called between polls and can raise to
+    # cancel (the worker is then stopped, cancelling the query on the server) as can a KeyboardInterrupt
+    def wait(self, check=None, on_rows=None):
+        try:
+            while True:
+                if check is not None:
+                    check()
+                if not self.pipe.poll(self.poll_interval):
+                    if not self.proc.is_alive() and not self.pipe.poll(0):
+                        raise WorkerError(self.deathMessage())
+                    continue
+                try:
+                    msg = self.pipe.recv()
+                except EOFError:
+                    self.proc.join(5)
+                    raise WorkerError(self.deathMessage())
+                if msg[0] == 'rows':
+                    self.rows = msg[1]
+                    if on_rows is not None:
+                        on_rows(self.rows)
+                    continue
+                self.proc.join(5)
+                return msg
+        except BaseException:
+            self.stop()
+            raise
+
+    def deathMessage(self):
+        code = self.proc.exitcode
+        if code is not None and code < 0 and -code == signal.SIGKILL:
+            return "The worker was killed after %s rows, most likely for using too much memory (worker_memory_mb is %s)" % (self.rows, self.memory_mb)
+        return "The worker exited unexpectedly with code %s after %s rows" % (code, self.rows)
+
+    # SIGTERM lets the worker cancel its query on the server, a worker that doesn't stop in grace seconds is killed
+    def stop(self, grace=5):
+        if self.proc is not None and self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join(grace)
+            if self.proc.is_alive():
+                self.proc.kill()
+                self.proc.join()
+        if self.pipe is not None:
+            self.pipe.close()
+            self.pipe = None
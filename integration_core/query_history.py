@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Per query timing with time.perf_counter, broken into phases, and a bounded history of finished queries
+# that can be shown as a DataFrame and optionally appended to a JSONL log file
+import json
+import time
+import weakref
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from integration_core.lazy_import import lazyModule
+pd = lazyModule('pandas')
+
+# Phases in the order they happen, every history record has a column for each (None if the phase didn't run)
+# first_row is the wait for the first batch after execute returns, fetch is the rest of the fetching
+phases = ['validate', 'acquire', 'execute', 'first_row', 'fetch', 'frame', 'spill', 'render']
+
+
+# Peak memory of a query. Writing 5 to /proc/self/clear_refs resets the high water mark of the kernel's resident memory
+# (VmHWM), so VmHWM read when a query finishes is the peak since it started. Queries that overlap (async, batch) share the
+# process, so the mark is only reset when no other query is running: the peak recorded is the process's while the query
+# ran, and the overlapping column says whether other queries were running too. None where there is no /proc
+active_profiles = weakref.WeakSet()   # Profiles of queries that haven't finished (dropped ones go away on their own)
+active_lock = threading.Lock()
+peak_tracked = False                  # Whether the mark was reset when the current run of overlapping queries started
+
+
+def resetPeakRss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peakRssMb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class QueryProfile(object):
+    def __init__(self, query, mode="sync"):
+        self.query = query
+        self.mode = mode
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()
+        self.rows = 0
+        self.bytes = None
+        self.status = "-"
+        self.total = None
+        self.lock = threading.Lock()
+        self.peak_rss = None
+        self.overlapping = False
+        self.startPeak()
+
+    def startPeak(self):
+        global peak_tracked
+        with active_lock:
+            if len(active_profiles) == 0:
+                peak_tracked = resetPeakRss()
+            else:
+                self.overlapping = True
+                for other in active_profiles:
+                    other.overlapping = True
+            self.peak_tracked = peak_tracked
+            active_profiles.add(self)
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - t)
+
+    def elapsed(self):
+        if self.total is not None:
+            return self.total
+        return time.perf_counter() - self.start
+
+    # Stop the clock. mydf (if given) is measured for bytes, deep is slower but counts string contents
+    def finish(self, status, rows=0, mydf=None, deep=False):
+        self.total = time.perf_counter() - self.start
+        with active_lock:
+            active_profiles.discard(self)
+        if self.peak_tracked:
+            self.peak_rss = peakRssMb()
+        self.status = status
+        self.rows = rows
+        if mydf is not None:
+            self.bytes = int(mydf.memory_usage(index=True, deep=deep).sum())
+
+    def record(self):
+        rec = OrderedDict()
+        rec['started'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))
+        rec['query'] = " ".join(self.query.split())[:200]
+        rec['mode'] = self.mode
+        rec['status'] = self.status
+        rec['rows'] = self.rows
+        rec['bytes'] = self.bytes
+        rec['total'] = self.elapsed()
+        for p in phases:
+            rec[p] = self.phases.get(p, None)
+        fetch_time = sum(self.phases.get(p, 0.0) for p in ['execute', 'first_row', 'fetch', 'frame'])
+        rec['rows_per_sec'] = None
+        if self.rows > 0 and fetch_time > 0:
+            rec['rows_per_sec'] = self.rows / fetch_time
+        rec['process_peak_rss_mb'] = self.peak_rss
+        rec['overlapping'] = self.overlapping
+        return rec
+
+    def summary(self):
+        parts = ["%s %.3fs" % (p, self.phases[p]) for p in phases if p in self.phases]
+        return "Total %.3fs: %s" % (self.elapsed(), ", ".join(parts))
+
+
+class QueryHistory(object):
+    def __init__(self, maxlen=100, log_path=""):
+        self.records = deque(maxlen=max(int(maxlen), 1))
+        self.log_path = log_path
+        self.lock = threading.Lock()
+
+    def add(self, profile):
+        rec = profile.record()
+        with self.lock:
+            self.records.append(rec)
+            if self.log_path is not None and self.log_path != "":
+                try:
+                    with open(self.log_path, "a") as f:
+                        f.write(json.dumps(rec) + "\n")
+                except (IOError, OSError) as e:
+                    print("WARNING - Could not write query history to %s: %s" % (self.log_path, e))
+        return rec
+
+    def resize(self, maxlen):
+        maxlen = max(int(maxlen), 1)
+        with self.lock:
+            if maxlen != self.records.maxlen:
+                self.records = deque(self.records, maxlen=maxlen)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def toDataFrame(self):
+        with self.lock:
+            return pd.DataFrame(list(self.records))
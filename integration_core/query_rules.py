@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+# Query validation rules. A query is tokenized once (comments and whitespace dropped, string literals kept as
+# single tokens so nothing inside them can match a rule) and every rule then runs over that token list.
+#
+# Rule severities match what validateQuery has always done:
+#   warn    - print a warning, the query still runs
+#   confirm - print a warning and don't run the first submission, running the same query again submits it
+#   block   - print an error, the query never runs
+#
+# A rule can be limited to statements starting with certain keywords (statements), so SET and USE lines of a batch script
+# aren't held to the rules for SELECTs
+#
+# Extra rules can be added with Integration.registerRule, the <name>_rule_modules opt (module:attribute),
+# or the "jupyter_<name>.query_rules" entry point group. A rule entry is a Rule subclass, a Rule instance, or a list of them
+import re
+from collections import namedtuple
+
+Token = namedtuple('Token', ['kind', 'text', 'lower', 'start', 'end', 'depth'])
+
+token_re = re.compile(r"""
+     (?P<ws>\s+)
+    |(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+    |(?P<string>'(?:[^'\\]|\\.)*(?:'|\Z)|"(?:[^"\\]|\\.)*(?:"|\Z))
+    |(?P<ident>`[^`]*(?:`|\Z)|[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+)
+    |(?P<op><=>|<=|>=|<>|!=|==|\|\||.)
+""", re.S | re.X)
+
+severities = ['warn', 'confirm', 'block']
+comparison_ops = ['=', '==', '<=>', '<', '>', '<=', '>=', '<>', '!=']
+
+
+# Split query into tokens, dropping whitespace and comments. depth is the parenthesis depth of the token
+def tokenize(query):
+    tokens = []
+    depth = 0
+    for m in token_re.finditer(query):
+        kind = m.lastgroup
+        if kind == 'ws' or kind == 'comment':
+            continue
+        text = m.group()
+        if text == ')':
+            depth = max(depth - 1, 0)
+        if kind == 'ident':
+            lower = text.strip('`').lower()
+        else:
+            lower = text
+        tokens.append(Token(kind, text, lower, m.start(), m.end(), depth))
+        if text == '(':
+            depth += 1
+    return tokens
+
+
+class ParsedQuery(object):
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+
+    # Index of the first identifier token equal to keyword (lower case), optionally only at paren depth 0
+    def find(self, keyword, top_level=False, start=0):
+        for i in range(start, len(self.tokens)):
+            tok = self.tokens[i]
+            if tok.kind == 'ident' and tok.lower == keyword and (top_level == False or tok.depth == 0):
+                return i
+        return -1
+
+    def has(self, keyword, top_level=False):
+        return self.find(keyword, top_level) >= 0
+
+    # The first keyword of the statement (select, with, set, use, insert...), "" if there is none
+    def verb(self):
+        for tok in self.tokens:
+            if tok.kind == 'ident':
+                return tok.lower
+        return ""
+
+    # Statements split on ; outside of literals and comments, empty statements dropped
+    def statements(self):
+        out = []
+        start = 0
+        for tok in self.tokens:
+            if tok.kind == 'op' and tok.text == ';':
+                out.append(self.query[start:tok.start])
+                start = tok.end
+        out.append(self.query[start:])
+        return [x.strip() for x in out if len(tokenize(x)) > 0]
+
+    # Index of the row count token of the last top level LIMIT (LIMIT count or LIMIT offset, count), -1 if there isn't one
+    def limitToken(self):
+        toks = self.tokens
+        idx = -1
+        i = self.find('limit', top_level=True)
+        while i >= 0:
+            idx = i
+            i = self.find('limit', top_level=True, start=i + 1)
+        if idx < 0 or idx + 1 >= len(toks) or toks[idx + 1].kind != 'number':
+            return -1
+        if idx + 3 < len(toks) and toks[idx + 2].text == ',' and toks[idx + 3].kind == 'number':
+            return idx + 3
+        return idx + 1
+
+    # The row count of the top level LIMIT, None if the query has none
+    def limit(self):
+        count = self.limitToken()
+        if count < 0:
+            return None
+        return int(float(self.tokens[count].text))
+
+    # The query with anything after the last real token (trailing comments, whitespace, semicolons) removed
+    def trimmed(self):
+        toks = [t for t in self.tokens if not (t.kind == 'op' and t.text == ';')]
+        if len(toks) == 0:
+            return ""
+        return self.query[:toks[-1].end]
+
+
+class Rule(object):
+    name = "rule"
+    severity = "warn"
+    message = ""
+    statements = None   # First keywords of the statements the rule applies to, None for every statement
+
+    def __init__(self, severity=None):
+        if severity is not None:
+            self.severity = severity
+        if self.severity not in severities:
+            raise ValueError("Rule %s severity must be one of %s" % (self.name, ", ".join(severities)))
+
+    def applies(self, parsed):
+        return self.statements is None or parsed.verb() in self.statements
+
+    # Return True if parsed breaks the rule. integration is the Integration running the query (for opts)
+    def check(self, parsed, integration):
+        return False
+
+    # Return a rewritten query that satisfies the rule, or None to leave it alone (checked before check())
+    def rewrite(self, parsed, integration):
+        return None
+
+
+class SemicolonRule(Rule):
+    name = "semicolon"
+    severity = "warn"
+    message = "Do not type a trailing semi colon on queries, your query will fail (like it probably did here)"
+
+    def check(self, parsed, integration):
+        for tok in parsed.tokens:
+            if tok.kind == 'op' and tok.text == ';':
+                return True
+        return False
+
+
+# The partition column (<name>_partition_col, day by default) must be compared in a WHERE clause, either
+# as col = x, col > x ..., col BETWEEN, or col IN. Qualified references like t.day count too
+class PartitionRule(Rule):
+    name = "partition"
+    severity = "confirm"
+    template = "Queries shoud have a %s = component to ensure you don't have to many map tasks"
+    message = template % "day"
+    statements = ['select', 'with']
+
+    def partitionCol(self, integration):
+        return str(integration.opts[integration.name_str + '_partition_col'][0]).lower()
+
+    def check(self, parsed, integration):
+        col = self.partitionCol(integration)
+        self.message = self.template % col
+        toks = parsed.tokens
+        in_where = False
+        for i in range(len(toks)):
+            tok = toks[i]
+            if tok.kind != 'ident':
+                continue
+            if tok.lower == 'where':
+                in_where = True
+            elif in_where and tok.lower == col and i + 1 < len(toks):
+                nxt = toks[i + 1]
+                if (nxt.kind == 'op' and nxt.text in comparison_ops) or nxt.lower in ['between', 'in']:
+                    return False
+                if nxt.lower == 'not' and i + 2 < len(toks) and toks[i + 2].lower in ['between', 'in']:
+                    return False
+        return True
+
+
+# Every query needs a top level LIMIT. With <name>_auto_limit set, a LIMIT of <name>_max_rows is added instead
+class LimitRule(Rule):
+    name = "limit"
+    severity = "block"
+    message = "All queries must have a limit clause - Query will not submit without out"
+    statements = ['select', 'with']
+
+    def check(self, parsed, integration):
+        return not parsed.has('limit', top_level=True)
+
+    def rewrite(self, parsed, integration):
+        if integration.opts[integration.name_str + '_auto_limit'][0] != True:
+            return None
+        if parsed.has('limit', top_level=True) or not parsed.has('select', top_level=True):
+            return None
+        max_rows = int(integration.opts[integration.name_str + '_max_rows'][0])
+        print("NOTE - No limit clause, adding LIMIT %s (%s_max_rows)" % (max_rows, integration.name_str))
+        return "%s\nLIMIT %s" % (parsed.trimmed(), max_rows)
+
+
+default_rules = [SemicolonRule, PartitionRule, LimitRule]
+
+
+def makeRules(obj):
+    if isinstance(obj, (list, tuple)):
+        out = []
+        for x in obj:
+            out.extend(makeRules(x))
+        return out
+    if isinstance(obj, type) and issubclass(obj, Rule):
+        return [obj()]
+    if isinstance(obj, Rule):
+        return [obj]
+    raise TypeError("%r is not a Rule class or instance" % (obj,))
+
+
+# Import module:attribute and turn it into rules
+def importRules(spec):
+    import importlib
+    mod_name, sep, attr = spec.strip().partition(":")
+    obj = importlib.import_module(mod_name)
+    if sep != "":
+        for part in attr.split("."):
+            obj = getattr(obj, part)
+    return makeRules(obj)
+
+
+def entryPointRules(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=group)
+    else:
+        eps = eps.get(group, [])
+    out = []
+    for ep in eps:
+        try:
+            out.extend(makeRules(ep.load()))
+        except Exception as e:
+            print("WARNING - Could not load query rule %s: %s" % (ep.name, e))
+    return out
+
+
+class QueryValidator(object):
+    def __init__(self, rules=None):
+        self.rules = []
+        if rules is None:
+            rules = default_rules
+        for rule in makeRules(list(rules)):
+            self.register(rule)
+
+    # Rules are keyed on name, registering a rule with the same name replaces the old one
+    def register(self, rule):
+        for rule in makeRules(rule):
+            self.rules = [r for r in self.rules if r.name != rule.name] + [rule]
+
+    # Runs every enabled rule over one tokenization of query
+    # rerun is True if this is the second submission in a row of the same query
+    # Returns whether to run, and the query to run (which rules may have rewritten)
+    def validate(self, query, integration, rerun=False, disabled=None):
+        if disabled is None:
+            disabled = []
+        rules = [r for r in self.rules if r.name not in disabled]
+        parsed = ParsedQuery(query)
+        for rule in rules:
+            if not rule.applies(parsed):
+                continue
+            new_query = rule.rewrite(parsed, integration)
+            if new_query is not None:
+                parsed = ParsedQuery(new_query)
+
+        bRun = True
+        confirm = False
+        for rule in rules:
+            if not rule.applies(parsed) or rule.check(parsed, integration) == False:
+                continue
+            if rule.severity == 'warn':
+                print("WARNING - %s" % rule.message)
+            elif rule.severity == 'confirm':
+                print("WARNING - %s" % rule.message)
+                confirm = True
+            else:
+                print("ERROR - %s" % rule.message)
+                bRun = False
+        if confirm == True and bRun == True:
+            if rerun == False:
+                print("First Submission - Not Sending to Server - Run again to submit as is")
+                bRun = False
+            else:
+                print("Query will be submitted ")
+        return bRun, parsed.query
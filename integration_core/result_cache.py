@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+# On disk cache of query results, so rerunning a notebook (even after a kernel restart) doesn't rerun the same scans.
+# Entries are keyed on the normalized query text plus the connection identity, stored as Parquet
+# (pickle if Parquet isn't available or can't hold the frame), and evicted by TTL and total size (least recently used first)
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from integration_core.lazy_import import lazyModule
+pd = lazyModule('pandas')
+
+
+# Collapse runs of whitespace outside of string literals and drop trailing semicolons
+# so formatting-only differences map to the same cache entry. Case is kept, since it matters inside literals
+def normalizeQuery(query):
+    out = []
+    quote = None
+    space = False
+    for c in query.strip():
+        if quote is not None:
+            out.append(c)
+            if c == quote:
+                quote = None
+        elif c in "'\"`":
+            if space:
+                out.append(" ")
+                space = False
+            quote = c
+            out.append(c)
+        elif c.isspace():
+            space = True
+        else:
+            if space:
+                out.append(" ")
+                space = False
+            out.append(c)
+    return "".join(out).rstrip("; ")
+
+
+# Write df to path.parquet, or path.pkl if Parquet isn't available or can't hold the frame. The file is written under a
+# .tmp name and moved into place, so it is never seen half written. Returns the file written and its format (for readFrame)
+def writeFrame(path, df):
+    fname = path + ".parquet"
+    fmt = "parquet"
+    try:
+        df.to_parquet(fname + ".tmp")
+    except Exception:
+        # No parquet engine installed, or column types Parquet can't store
+        if os.path.exists(fname + ".tmp"):
+            os.remove(fname + ".tmp")
+        fname = path + ".pkl"
+        fmt = "pickle"
+        df.to_pickle(fname + ".tmp")
+    os.replace(fname + ".tmp", fname)
+    return fname, fmt
+
+
+def readFrame(fname, fmt):
+    if fmt == "parquet":
+        return pd.read_parquet(fname)
+    return pd.read_pickle(fname)
+
+
+# Several kernels can share one cache directory. Every operation holds an flock on lock_file and re-reads the index
+# first, so kernels see each other's entries instead of overwriting them (without fcntl, only threads are locked out)
+class ResultCache(object):
+    index_file = "index.json"
+    lock_file = "index.lock"
+
+    def __init__(self, path, ttl=86400, max_bytes=1073741824):
+        self.path = os.path.expanduser(path)
+        self.ttl = int(ttl)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index = self.loadIndex()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            with open(os.path.join(self.path, self.lock_file), "a") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self.index = self.loadIndex()
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def loadIndex(self):
+        try:
+            with open(os.path.join(self.path, self.index_file)) as f:
+                return OrderedDict(json.load(f, object_pairs_hook=OrderedDict))
+        except (IOError, OSError, ValueError):
+            return OrderedDict()
+
+    def saveIndex(self):
+        tmp = os.path.join(self.path, self.index_file + ".%s.tmp" % os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.path, self.index_file))
+
+    def key(self, query, identity=""):
+        return hashlib.sha256((identity + "\n" + normalizeQuery(query)).encode("utf-8")).hexdigest()
+
+    def removeEntry(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            try:
+                os.remove(os.path.join(self.path, entry['file']))
+            except OSError:
+                pass
+
+    # Returns the cached DataFrame for key, or None if there is no fresh entry
+    def get(self, key):
+        with self.locked():
+            entry = self.index.get(key, None)
+            if entry is not None and self.ttl > 0 and time.time() - entry['created'] > self.ttl:
+                self.removeEntry(key)
+                self.saveIndex()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                df = readFrame(os.path.join(self.path, entry['file']), entry['format'])
+            except Exception:
+                self.removeEntry(key)
+                self.saveIndex()
+                self.misses += 1
+                return None
+            entry['accessed'] = time.time()
+            self.index.move_to_end(key)
+            self.saveIndex()
+            self.hits += 1
+            return df
+
+    def put(self, key, df, query=""):
+        with self.locked():
+            self.removeEntry(key)
+            path, fmt = writeFrame(os.path.join(self.path, key), df)
+            fname = os.path.basename(path)
+            now = time.time()
+            self.index[key] = {'file': fname, 'format': fmt, 'bytes': os.path.getsize(path),
+                               'rows': len(df), 'created': now, 'accessed': now, 'query': query[:200]}
+            self.evict()
+            self.saveIndex()
+
+    # Drop expired entries, then least recently used entries until the cache fits in max_bytes. Call with locked() held
+    # Result files no entry points to (left by a kernel that died before saving the index) are removed too
+    def evict(self):
+        now = time.time()
+        if self.ttl > 0:
+            for key in [k for k, v in self.index.items() if now - v['created'] > self.ttl]:
+                self.removeEntry(key)
+        total = sum(v['bytes'] for v in self.index.values())
+        while self.max_bytes > 0 and total > self.max_bytes and len(self.index) > 0:
+            key = next(iter(self.index))
+            total -= self.index[key]['bytes']
+            self.removeEntry(key)
+        known = set(v['file'] for v in self.index.values())
+        for fname in os.listdir(self.path):
+            if (fname.endswith(".parquet") or fname.endswith(".pkl")) and fname not in known:
+                try:
+                    os.remove(os.path.join(self.path, fname))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.locked():
+            for key in list(self.index.keys()):
+                self.removeEntry(key)
+            self.evict()
+            self.saveIndex()
+
+    def status(self):
+        with self.locked():
+            return OrderedDict([('path', self.path), ('entries', len(self.index)), ('bytes', sum(v['bytes'] for v in self.index.values())),
+                                ('max_bytes', self.max_bytes), ('ttl', self.ttl), ('hits', self.hits), ('misses', self.misses)])
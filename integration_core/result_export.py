@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# Writers that save query results batch by batch as they are fetched (so the full result never has to fit in memory)
+# and a loader that memory maps the saved file back. Targets are given as format:path, for example parquet:/data/out.parquet
+import os
+
+from integration_core.lazy_import import lazyModule, isAvailable
+
+# pyarrow is only needed for parquet and arrow targets, so it is imported on first use and we fail well if its not there
+pa = lazyModule('pyarrow')
+pq = lazyModule('pyarrow.parquet')
+pd = lazyModule('pandas')
+
+export_formats = ['csv', 'parquet', 'arrow']
+format_extensions = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+
+
+def requirePyarrow(fmt):
+    if not isAvailable('pyarrow'):
+        raise ImportError("pyarrow is required to read or write %s results - pip install pyarrow" % fmt)
+
+
+# Split a target of the form format:path. Without a format prefix, the format comes from the file extension (csv if unknown)
+def parseTarget(target):
+    fmt, sep, path = target.partition(":")
+    if sep != "" and fmt.lower() in export_formats:
+        return fmt.lower(), os.path.expanduser(path)
+    path = os.path.expanduser(target)
+    return format_extensions.get(os.path.splitext(path)[1].lower(), 'csv'), path
+
+
+class CsvResultWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "w")
+        self.header = True
+
+    def write(self, batch):
+        batch.to_csv(self.f, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.f.close()
+
+
+# Base for the Arrow based writers. The schema comes from the first batch, columns that are all null there
+# are stored as strings, and later batches are cast to that schema
+class ArrowResultWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.schema = None
+        self.writer = None
+
+    def toTable(self, batch):
+        if self.schema is None:
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            fields = []
+            for field in table.schema:
+                if pa.types.is_null(field.type):
+                    field = field.with_type(pa.string())
+                fields.append(field)
+            self.schema = pa.schema(fields)
+            return table.cast(self.schema)
+        try:
+            return pa.Table.from_pandas(batch, schema=self.schema, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.Table.from_pandas(batch, preserve_index=False).cast(self.schema)
+
+    def write(self, batch):
+        table = self.toTable(batch)
+        if self.writer is None:
+            self.writer = self.openWriter()
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetResultWriter(ArrowResultWriter):
+    def openWriter(self):
+        return pq.ParquetWriter(self.path, self.schema)
+
+
+class ArrowIpcResultWriter(ArrowResultWriter):
+    def openWriter(self):
+        self.sink = pa.OSFile(self.path, "wb")
+        return pa.ipc.new_file(self.sink, self.schema)
+
+    def close(self):
+        ArrowResultWriter.close(self)
+        if self.writer is not None:
+            self.sink.close()
+
+
+def openResultWriter(fmt, path):
+    if fmt == 'csv':
+        return CsvResultWriter(path)
+    requirePyarrow(fmt)
+    if fmt == 'parquet':
+        return ParquetResultWriter(path)
+    if fmt == 'arrow':
+        return ArrowIpcResultWriter(path)
+    raise ValueError("Unknown export format %s - use one of %s" % (fmt, ", ".join(export_formats)))
+
+
+# Load a parquet or arrow result back as a pyarrow Table. Only Arrow files are zero copy: they are memory mapped, the data
+# is only paged in as it is used, and results bigger than RAM can be opened. Parquet has to be decoded, so the whole file
+# (or columns) is read into memory - use openResult to read it a part at a time. Use .to_pandas() on the table for a DataFrame
+def loadResult(target, columns=None):
+    fmt, path = parseTarget(target)
+    if fmt == 'csv':
+        raise ValueError("CSV results can't be memory mapped, use pd.read_csv on %s" % path)
+    requirePyarrow(fmt)
+    if fmt == 'parquet':
+        return pq.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+# Open a saved result without reading its data. Arrow files are memory mapped as a Table (see loadResult), parquet files
+# are opened as a pq.ParquetFile, which only decodes what is asked for (.read(columns=[...]), .read_row_group(i), .iter_batches())
+def openResult(target):
+    fmt, path = parseTarget(target)
+    if fmt == 'parquet':
+        requirePyarrow(fmt)
+        return pq.ParquetFile(path, memory_map=True)
+    return loadResult(target)
+
+
+# The first rows of a saved result as a DataFrame, reading no more of the file than that
+def readHead(target, rows):
+    fmt, path = parseTarget(target)
+    if fmt == 'csv':
+        return pd.read_csv(path, nrows=rows)
+    requirePyarrow(fmt)
+    if fmt == 'parquet':
+        pfile = pq.ParquetFile(path, memory_map=True)
+        for batch in pfile.iter_batches(batch_size=max(int(rows), 1)):
+            return batch.to_pandas().iloc[:rows]
+        return pfile.schema_arrow.empty_table().to_pandas()
+    return loadResult(target).slice(0, rows).to_pandas()
@@ -0,0 +1,7 @@
+# integration_base uses name_str = integration until a real integration fills it in, so the template itself is tested as hive
+import os
+import sys
+import builtins
+
+builtins.integration = "hive"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
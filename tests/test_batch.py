@@ -0,0 +1,71 @@
+from IPython.testing.globalipapp import get_ipython
+
+from integration_core import Integration
+
+
+class RecordingCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rows = []
+
+    def execute(self, query):
+        self.conn.executed.append(query)
+        if query.lower().startswith("select"):
+            self.description = [('a', None, None, None, None, None, None)]
+            self.rows = [(1,), (2,)]
+        else:
+            self.description = None
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        out = self.rows[:size]
+        self.rows = self.rows[size:]
+        return out
+
+    def close(self):
+        pass
+
+
+class RecordingConnection(object):
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def close(self):
+        pass
+
+
+def test_serial_batch_runs_set_and_use_before_select():
+    shell = get_ipython()
+    conn = RecordingConnection()
+    integration = Integration(shell)
+    integration.newConnection = lambda: conn
+    integration.opts['hive_pool_ping_interval'][0] = 0
+    integration.auth()
+    integration.connected = True
+    shell.user_ns.pop('prev_hive', None)
+
+    integration.hive("--batch --serial", "SET hive.exec.parallel=true;\nUSE sales;\nSELECT a FROM t WHERE day = '2020-01-01' LIMIT 10")
+
+    assert conn.executed == ["SET hive.exec.parallel=true", "USE sales", "SELECT a FROM t WHERE day = '2020-01-01' LIMIT 10"]
+    assert len(shell.user_ns['prev_hive']) == 2
+
+
+def test_select_in_batch_still_needs_a_limit():
+    shell = get_ipython()
+    conn = RecordingConnection()
+    integration = Integration(shell)
+    integration.newConnection = lambda: conn
+    integration.opts['hive_pool_ping_interval'][0] = 0
+    integration.auth()
+    integration.connected = True
+
+    integration.hive("--batch --serial", "USE sales;\nSELECT a FROM t WHERE day = '2020-01-01'")
+
+    assert conn.executed == []
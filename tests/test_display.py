@@ -0,0 +1,14 @@
+import pandas as pd
+
+from integration_core import Integration
+
+
+def test_replace_crlf_shows_literal_escapes():
+    integration = Integration.__new__(Integration)
+    df = pd.DataFrame({'a': ["one\r\ntwo", "three"], 'b': [1, 2]})
+    shown = integration.prepareDisplay(df)
+    assert shown['a'][0] == "one\\r\\ntwo"
+    assert "\n" not in shown['a'][0] and "\r" not in shown['a'][0]
+    assert shown['a'][1] == "three"
+    # prev_<name> keeps the raw value
+    assert df['a'][0] == "one\r\ntwo"